@@ -14,14 +14,71 @@ Features:
 - Selects best quality volume based on vessel signal
 
 Usage:
-    python Zeiss_OCTA_Converter.py <folder_name>
+    python Zeiss_OCTA_Converter.py <folder_name> [options]
     
     Example: python Zeiss_OCTA_Converter.py HenkE433
+             python Zeiss_OCTA_Converter.py HenkE433 --workers 8
+
+Options:
+    --workers N   Decode DICOM files on N processes (0 = all cores, default 1)
+    --threads N   Frame-decoding threads per file (default: all cores / workers;
+                  needs imagecodecs, pylibjpeg-openjpeg decodes serially)
+    --no-prescan  Decompress every file instead of only the majority-shape group
+    --no-dedupe   Decode files with byte-identical PixelData more than once
+    --preview-decode N
+                  Score candidates from every Nth B-scan (4 or 8), fully decode only the winner
+    --preview-report
+                  Compare preview and full-decode rankings; <folder_name> may be
+                  a single exam or a folder of exams
+    --no-cache    Do not use the decoded-volume cache (Cache/, LRU, size-capped)
+    --cache-dir DIR, --cache-size GB
+                  Cache location and size cap (default: Cache/, 10 GB)
+    --clear-cache Delete all cached volumes before converting
+    --repair-report
+                  Repair every header in the folder and report the fixes (no conversion)
+    --score SPEC  Selection metrics and weights, e.g. 'contrast' (default),
+                  'vessels' or 'contrast,motion:0.5'. Metrics: contrast,
+                  vessels, mean, std, entropy, motion (mean difference between
+                  neighbouring rows of the en-face MIP, i.e. eye-motion line
+                  artefacts; lower is better)
+    --sample      Score from progressively sampled B-scans, stop once the leader
+                  is separated from the rest, fully decode only the winner
+    --sample-confidence C, --sample-stride N
+                  Confidence for the early exit (default 0.99) and stride of
+                  the first sampling round (default 16)
+    --verify-sampling
+                  Run sampled scoring, then full scoring, and check the selections match
+    --outputs LIST
+                  Outputs to write, comma-separated (default: npy,json,tiff,nifti,ims,preview;
+                  add zarr for a chunked OME-Zarr)
+    --zarr-chunks Z,Y,X
+                  OME-Zarr chunk shape (default 64,128,128)
+    --preview-style {fast,matplotlib}
+                  Built-in preview renderer (default, no matplotlib needed) or the
+                  titled matplotlib figure
+    --rebuild     Ignore Results/<folder>/manifest.json and convert from scratch
+                  (by default, unchanged inputs only rebuild missing or stale outputs)
+    --writer-threads N
+                  Threads for the concurrent output writers (default: one per output)
+    --tiff-format {imagej,bigtiff}
+                  Uncompressed ImageJ stack (default) or tiled, compressed BigTIFF
+                  (OME metadata carries the voxel size)
+    --tiff-compression {zlib,lzw,zstd}, --tiff-tile N
+                  BigTIFF compression (default zlib; lzw/zstd need imagecodecs)
+                  and tile size (default 256), tiles compressed on all cores
+    --nifti-compression {gzip,parallel,none}
+                  NIfTI as single-stream .nii.gz (default), multi-threaded block
+                  gzip .nii.gz, or uncompressed .nii
+    --nifti-level L
+                  gzip level 1-9 for the NIfTI (default 1, as nibabel)
+    --nifti-benchmark
+                  Write the selected volume with each NIfTI setting and print size vs time
 
 Output:
     - OCTA_<folder>.tif       : 3D TIFF file for Imaris
     - OCTA_<folder>.npy       : NumPy array
     - OCTA_<folder>_metadata.json : Scan parameters and voxel size
+    - OCTA_<folder>.ims       : Native Imaris file with resolution pyramid
     - OCTA_<folder>_Preview.png  : Visualization (MIP projections)
 
 Author: Automated conversion script for UCSF OCTA analysis
@@ -31,9 +88,22 @@ Date: 2025-11-12
 import pydicom
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import deque
+from io import BytesIO
+from statistics import NormalDist
+import argparse
+import gzip
+import hashlib
 import warnings
 import json
+import os
+import shutil
+import struct
 import sys
+import threading
+import time
+import zlib
 
 # UTF-8 output for Windows
 if sys.platform == 'win32':
@@ -43,6 +113,8 @@ if sys.platform == 'win32':
 
 warnings.filterwarnings('ignore')
 
+__version__ = "1.1.0.dev0"
+
 def fix_dicom_metadata(dcm):
     """
     Fix corrupted DICOM metadata commonly found in Zeiss Cirrus exports.
@@ -90,7 +162,792 @@ def fix_dicom_metadata(dcm):
     
     return dcm
 
-def read_dicom_robust(file_path):
+# Raw header repair engine
+# Explicit VRs with a 2-byte reserved field and a 4-byte length
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV',
+                    b'UC', b'UN', b'UR', b'UT', b'UV'}
+_PIXEL_DATA_TAG = 0x7FE00010
+_ITEM_DELIMITER_TAG = 0xFFFEE00D
+_SEQUENCE_DELIMITER = 0xFFFEE0DD
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Header elements repaired by repair_header_bytes: tag -> (keyword, VR)
+_REPAIR_TAGS = {
+    0x00280004: ('PhotometricInterpretation', b'CS'),
+    0x00280008: ('NumberOfFrames', b'IS'),
+    0x00280010: ('Rows', b'US'),
+    0x00280011: ('Columns', b'US'),
+}
+
+class _TruncatedHeader(Exception):
+    """The header buffer ends before the element being parsed."""
+
+def _read_tag(buf, pos, endian):
+    if pos + 4 > len(buf):
+        raise _TruncatedHeader()
+    group, element = struct.unpack_from(endian + 'HH', buf, pos)
+    return (group << 16) | element
+
+def _parse_element(buf, pos, explicit, endian):
+    """
+    Parse the element header at pos.
+    
+    Returns (tag, vr, value_offset, value_length, next_offset); undefined
+    length values (sequences) are skipped over to find next_offset.
+    """
+    tag = _read_tag(buf, pos, endian)
+    vr = None
+    if tag >> 16 == 0xFFFE:
+        # Item / delimiter tags never have a VR
+        value_offset = pos + 8
+        length_format, length_offset = 'I', pos + 4
+    elif explicit:
+        vr = bytes(buf[pos + 4:pos + 6])
+        if vr in _LONG_LENGTH_VRS:
+            value_offset = pos + 12
+            length_format, length_offset = 'I', pos + 8
+        else:
+            value_offset = pos + 8
+            length_format, length_offset = 'H', pos + 6
+    else:
+        value_offset = pos + 8
+        length_format, length_offset = 'I', pos + 4
+    
+    if value_offset > len(buf):
+        raise _TruncatedHeader()
+    length = struct.unpack_from(endian + length_format, buf, length_offset)[0]
+    
+    if length == _UNDEFINED_LENGTH:
+        if tag == _PIXEL_DATA_TAG:
+            return tag, vr, value_offset, length, value_offset
+        return tag, vr, value_offset, length, _skip_sequence(buf, value_offset, explicit, endian)
+    
+    next_offset = value_offset + length
+    if next_offset > len(buf) and tag != _PIXEL_DATA_TAG:
+        raise _TruncatedHeader()
+    return tag, vr, value_offset, length, next_offset
+
+def _skip_sequence(buf, pos, explicit, endian):
+    """Return the offset just past an undefined-length sequence starting at pos."""
+    while True:
+        tag = _read_tag(buf, pos, endian)
+        if pos + 8 > len(buf):
+            raise _TruncatedHeader()
+        length = struct.unpack_from(endian + 'I', buf, pos + 4)[0]
+        pos += 8
+        if tag == _SEQUENCE_DELIMITER:
+            return pos
+        if length != _UNDEFINED_LENGTH:
+            pos += length
+            continue
+        # Undefined-length item: nested elements up to the item delimiter
+        while _read_tag(buf, pos, endian) != _ITEM_DELIMITER_TAG:
+            pos = _parse_element(buf, pos, explicit, endian)[4]
+        pos += 8
+
+def _scan_header(buf):
+    """
+    Walk the top-level elements of a DICOM byte buffer up to PixelData.
+    
+    Returns (pixel_data_offset, explicit, endian, elements) where elements
+    maps each tag in _REPAIR_TAGS to (start, end, vr, value bytes).
+    pixel_data_offset is None if the buffer holds no PixelData element.
+    """
+    pos = 0
+    ts_uid = None
+    if bytes(buf[128:132]) == b'DICM':
+        # File meta group is always explicit VR little endian
+        pos = 132
+        while pos + 4 <= len(buf) and _read_tag(buf, pos, '<') >> 16 == 0x0002:
+            tag, _, value_offset, length, pos = _parse_element(buf, pos, True, '<')
+            if tag == 0x00020010:
+                ts_uid = bytes(buf[value_offset:value_offset + length]).strip(b'\x00 ').decode('ascii', 'replace')
+    
+    if ts_uid == '1.2.840.10008.1.2':
+        explicit, endian = False, '<'
+    elif ts_uid == '1.2.840.10008.1.2.2':
+        explicit, endian = True, '>'
+    elif ts_uid == '1.2.840.10008.1.2.1.99':
+        raise ValueError("Deflated transfer syntax is not supported")
+    elif ts_uid is not None:
+        explicit, endian = True, '<'
+    else:
+        # No file meta: guess from whether a VR follows the first tag
+        explicit, endian = bytes(buf[pos + 4:pos + 6]).isalpha(), '<'
+    
+    elements = {}
+    while pos < len(buf):
+        start = pos
+        tag, vr, value_offset, length, pos = _parse_element(buf, pos, explicit, endian)
+        if tag == _PIXEL_DATA_TAG:
+            return start, explicit, endian, elements
+        if tag in _REPAIR_TAGS:
+            elements[tag] = (start, pos, vr, bytes(buf[value_offset:pos]))
+    
+    return None, explicit, endian, elements
+
+def _encode_element(tag, vr, value, explicit, endian):
+    """Encode a short (2-byte length) element."""
+    if len(value) % 2:
+        value += b' ' if vr != b'US' else b'\x00'
+    encoded = struct.pack(endian + 'HH', tag >> 16, tag & 0xFFFF)
+    if explicit:
+        encoded += vr + struct.pack(endian + 'H', len(value))
+    else:
+        encoded += struct.pack(endian + 'I', len(value))
+    return encoded + value
+
+def _repaired_value(tag, vr, value, endian):
+    """Return (clean value bytes, clean value for the report) or None if valid."""
+    keyword, target_vr = _REPAIR_TAGS[tag]
+    
+    if target_vr == b'US' and len(value) == 2 and vr in (None, b'US'):
+        return None  # a proper binary US value
+    
+    text = value.decode('latin-1')
+    if keyword == 'PhotometricInterpretation':
+        for name in ('MONOCHROME2', 'MONOCHROME1'):
+            if name in text:
+                if text.rstrip(' \x00') == name:
+                    return None
+                return name.encode('ascii'), name
+        return None
+    
+    stripped = text.strip(' \x00')
+    if stripped.isdigit() and target_vr == b'IS':
+        return None
+    digits = ''.join(c for c in text if c.isdigit())
+    if not digits:
+        return None
+    if target_vr == b'US':
+        return struct.pack(endian + 'H', int(digits)), int(digits)
+    return digits.encode('ascii'), int(digits)
+
+def repair_header_bytes(header):
+    """
+    Repair corrupted Zeiss header elements directly in the raw bytes.
+    
+    Single pass over the top-level elements: PhotometricInterpretation,
+    NumberOfFrames, Rows and Columns are located by offset and rewritten
+    without null bytes or trailing garbage (same rules as
+    fix_dicom_metadata). Returns (fixed_bytes, fixes) where fixes is a list
+    of (keyword, old_value, new_value).
+    """
+    _, explicit, endian, elements = _scan_header(header)
+    
+    fixes = []
+    parts = []
+    pos = 0
+    for tag, (start, end, vr, value) in sorted(elements.items(), key=lambda item: item[1][0]):
+        repaired = _repaired_value(tag, vr, value, endian)
+        if repaired is None:
+            continue
+        clean_bytes, clean_value = repaired
+        keyword, target_vr = _REPAIR_TAGS[tag]
+        parts.append(header[pos:start])
+        parts.append(_encode_element(tag, target_vr, clean_bytes, explicit, endian))
+        pos = end
+        fixes.append((keyword, value.decode('latin-1'), clean_value))
+    parts.append(header[pos:])
+    
+    return b''.join(parts), fixes
+
+def read_header_bytes(file_path, chunk_size=256 * 1024):
+    """
+    Read the raw bytes of a DICOM file up to (not including) PixelData.
+    
+    Returns (header_bytes, has_pixel_data). The file is read in growing
+    chunks, so the pixel data itself is never loaded.
+    """
+    with open(file_path, 'rb') as fp:
+        data = fp.read(chunk_size)
+        while True:
+            try:
+                pixel_offset = _scan_header(data)[0]
+            except _TruncatedHeader:
+                pixel_offset = None
+            else:
+                if pixel_offset is not None:
+                    return data[:pixel_offset], True
+            more = fp.read(len(data))
+            if not more:
+                return data, False
+            data += more
+
+def read_repaired_header(file_path):
+    """
+    Read a DICOM header through the raw repair engine.
+    
+    Returns (dcm, fixes, header_bytes): the dataset is parsed once from the
+    already-repaired bytes, so no per-attribute fix-up is needed. The
+    PixelData element (if any) starts at len(header_bytes) in the file.
+    """
+    header, has_pixel_data = read_header_bytes(file_path)
+    fixed, fixes = repair_header_bytes(header)
+    dcm = pydicom.dcmread(BytesIO(fixed), force=True, stop_before_pixels=True)
+    if not has_pixel_data:
+        raise ValueError("No PixelData element")
+    return dcm, fixes, header
+
+def repair_folder_headers(dcm_files):
+    """
+    Batch mode: repair every header in a folder and report the fixes.
+    
+    Nothing is written back; input files are never modified. Returns a
+    dict mapping file name to its list of (keyword, old, new) fixes.
+    """
+    report = {}
+    for file_path in dcm_files:
+        try:
+            _, fixes, _ = read_repaired_header(file_path)
+        except Exception as e:
+            print(f"  {file_path.name}: could not repair header ({e})")
+            continue
+        report[file_path.name] = fixes
+        if fixes:
+            print(f"  {file_path.name}:")
+            for keyword, old, new in fixes:
+                print(f"    {keyword}: {old!r} → {new!r}")
+        else:
+            print(f"  {file_path.name}: OK")
+    
+    n_fixed = sum(1 for fixes in report.values() if fixes)
+    print(f"\nRepaired {n_fixed} of {len(report)} headers "
+          f"({sum(len(fixes) for fixes in report.values())} fixes)")
+    return report
+
+def read_dicomdir_index(dicomdir_path):
+    """
+    Parse a DICOMDIR once and index its IMAGE records.
+    
+    Walks the PATIENT/STUDY/SERIES/IMAGE directory records in order and
+    returns a list of dicts, one per referenced image file:
+    path, patient_id, study_date, series_number, modality,
+    series_description, laterality and the image record itself (which
+    carries Rows/Columns/NumberOfFrames when the exporter wrote them).
+    """
+    dicomdir = pydicom.dcmread(str(dicomdir_path), force=True)
+    base_dir = Path(dicomdir_path).parent
+    
+    # Case-insensitive lookup: referenced file IDs are usually upper case
+    existing = {}
+    
+    def resolve(file_id):
+        parts = [file_id] if isinstance(file_id, str) else list(file_id)
+        path = base_dir.joinpath(*parts)
+        if path.exists():
+            return path
+        folder = path.parent
+        if folder not in existing:
+            existing[folder] = {p.name.lower(): p for p in folder.iterdir()} if folder.is_dir() else {}
+        return existing[folder].get(path.name.lower())
+    
+    index = []
+    patient, study, series = {}, {}, {}
+    for record in dicomdir.DirectoryRecordSequence:
+        record_type = str(getattr(record, 'DirectoryRecordType', '')).strip()
+        if record_type == 'PATIENT':
+            patient = record
+        elif record_type == 'STUDY':
+            study = record
+        elif record_type == 'SERIES':
+            series = record
+        elif record_type == 'IMAGE' and 'ReferencedFileID' in record:
+            path = resolve(record.ReferencedFileID)
+            if path is None:
+                continue
+            laterality = getattr(record, 'ImageLaterality', None) or getattr(series, 'Laterality', '')
+            index.append({
+                'path': path,
+                'patient_id': str(getattr(patient, 'PatientID', '')),
+                'study_date': str(getattr(study, 'StudyDate', '')),
+                'series_number': str(getattr(series, 'SeriesNumber', '')),
+                'modality': str(getattr(series, 'Modality', '')),
+                'series_description': str(getattr(series, 'SeriesDescription', '')),
+                'laterality': str(laterality),
+                'record': record,
+            })
+    
+    return index
+
+def enumerate_dicom_files(data_folder):
+    """
+    List the DICOM files of an exam folder.
+    
+    When the folder has a DICOMDIR it is parsed once (read_dicomdir_index)
+    and the referenced files are used, so files do not have to be opened to
+    find out what they are. Otherwise all *.DCM files are globbed.
+    Returns (sorted file list, index or None).
+    """
+    dicomdir_path = data_folder / "DICOMDIR"
+    if dicomdir_path.exists():
+        try:
+            index = read_dicomdir_index(dicomdir_path)
+            if index:
+                return sorted({entry['path'] for entry in index}), index
+        except Exception as e:
+            print(f"  Warning: Could not parse DICOMDIR ({e}), scanning files instead")
+    
+    dcm_files = sorted(data_folder.glob("*.DCM"))
+    return [f for f in dcm_files if f.name != "DICOMDIR"], None
+
+def print_dicomdir_index(index):
+    """Print a one-line summary per series of a DICOMDIR index."""
+    series = {}
+    for entry in index:
+        key = (entry['series_number'], entry['modality'], entry['series_description'], entry['laterality'])
+        series[key] = series.get(key, 0) + 1
+    
+    print(f"DICOMDIR: {len(index)} images in {len(series)} series")
+    for (number, modality, description, laterality), count in series.items():
+        label = ' '.join(part for part in (modality, description, laterality) if part)
+        print(f"  Series {number or '?'}: {label or 'unknown'} ({count} images)")
+
+def needs_axis_swap(shape):
+    """
+    Check whether a decoded (frames, rows, cols) shape has X and Z swapped.
+    
+    OCTA data should be (Y, X, Z) where Z (depth) is typically 1024.
+    If the middle dimension is the largest, it is the depth axis and has
+    to be moved to the end.
+    """
+    return len(shape) == 3 and shape[1] > shape[2] and shape[1] > shape[0]
+
+def header_image_shape(dcm):
+    """
+    Work out the (Y, X, Z) shape a dataset will decode to, from its header only.
+    
+    Mirrors pixel_array's (NumberOfFrames, Rows, Columns) layout and the
+    axis swap applied in read_dicom_robust. Returns None for non-image files.
+    """
+    try:
+        rows = int(dcm.Rows)
+        cols = int(dcm.Columns)
+        frames = int(getattr(dcm, 'NumberOfFrames', 1) or 1)
+        samples = int(getattr(dcm, 'SamplesPerPixel', 1) or 1)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    
+    shape = (frames, rows, cols) if frames > 1 else (rows, cols)
+    if samples > 1:
+        shape = shape + (samples,)
+    
+    if needs_axis_swap(shape):
+        shape = (shape[0], shape[2], shape[1])
+    return shape
+
+def read_dicom_header(file_path):
+    """
+    Read and repair a DICOM header without loading the pixel data.
+    
+    Uses the raw-byte repair engine; headers it cannot walk are parsed by
+    pydicom and repaired with fix_dicom_metadata instead.
+    """
+    try:
+        return read_repaired_header(file_path)[0]
+    except Exception:
+        pass
+    try:
+        dcm = pydicom.dcmread(str(file_path), force=True, stop_before_pixels=True)
+        return fix_dicom_metadata(dcm)
+    except Exception as e:
+        print(f"  Header read error ({Path(file_path).name}): {e}")
+        return None
+
+def prescan_headers(dcm_files, index=None):
+    """
+    Header-only first pass: keep only files in the majority 3D shape group.
+    
+    Uses the same grouping rule as select_best_volume (most common 3D shape,
+    first group wins ties), so only files that could be selected are
+    decompressed. If a DICOMDIR index is given, files whose IMAGE record
+    carries Rows/Columns/NumberOfFrames giving a valid 3D shape are grouped
+    without being opened; for any other record (no NumberOfFrames, corrupt
+    values) the file's own header is read instead.
+    Returns (candidate_files, target_shape).
+    """
+    records = {}
+    for entry in index or []:
+        if all(key in entry['record'] for key in ('Rows', 'Columns', 'NumberOfFrames')):
+            records[entry['path']] = entry['record']
+    
+    shape_groups = {}
+    for file_path in dcm_files:
+        shape = header_image_shape(records[file_path]) if file_path in records else None
+        if shape is None or len(shape) != 3:
+            dcm = read_dicom_header(file_path)
+            if dcm is None:
+                continue
+            shape = header_image_shape(dcm)
+        if shape is None or len(shape) != 3:
+            continue
+        shape_groups.setdefault(shape, []).append(file_path)
+    
+    if not shape_groups:
+        return [], None
+    
+    target_shape, candidates = max(shape_groups.items(), key=lambda x: len(x[1]))
+    return candidates, target_shape
+
+def pixel_data_digest(file_path, chunk_size=1024 * 1024):
+    """
+    Content hash of a file's PixelData as stored (compressed fragments for
+    JPEG 2000), without decoding it.
+    
+    The digest also covers the transfer syntax and the repaired header's
+    image geometry, so equal bytes are only matched when they decode to the
+    same volume. Returns a hex digest, or None if the file cannot be read.
+    """
+    digest, offset = _pixel_digest_start(file_path)
+    if digest is None:
+        return None
+    with open(file_path, 'rb') as fp:
+        fp.seek(offset)
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _pixel_digest_start(file_path):
+    """(sha1 seeded with the image geometry, PixelData offset), or (None, None)."""
+    try:
+        dcm, _, header = read_repaired_header(file_path)
+    except Exception:
+        return None, None
+    
+    digest = hashlib.sha1()
+    geometry = (_transfer_syntax(dcm), header_image_shape(dcm),
+                getattr(dcm, 'BitsAllocated', None), getattr(dcm, 'PixelRepresentation', None))
+    digest.update(repr(geometry).encode())
+    return digest, len(header)
+
+def file_digests(file_path, chunk_size=1024 * 1024):
+    """
+    (SHA-1 of the whole file, pixel_data_digest) from a single read of the file.
+    
+    Used for the manifest's input hashes, so that dedupe_volumes can reuse
+    the PixelData digest instead of reading every candidate again. The
+    pixel digest is None if the file has no readable PixelData.
+    """
+    pixel, offset = _pixel_digest_start(file_path)
+    digest = hashlib.sha1()
+    position = 0
+    with open(file_path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+            if pixel is not None and position + len(chunk) > offset:
+                pixel.update(chunk[max(0, offset - position):])
+            position += len(chunk)
+    return digest.hexdigest(), pixel.hexdigest() if pixel is not None else None
+
+def dedupe_volumes(dcm_files, data_folder, inputs=None):
+    """
+    Collapse files whose PixelData is byte-identical before anything is decoded.
+    
+    Zeiss exports often contain the same cube more than once (re-exports or
+    copies under new UIDs). The first file of each group is kept, which is
+    also the one select_best_volume keeps on equal scores, so the selection
+    is unchanged. Returns (unique_files, duplicates) where duplicates is a
+    list of {'file': path, 'duplicate_of': path}, relative to data_folder
+    (DICOMDIR series folders reuse file names such as IM000000).
+    PixelData digests already recorded in `inputs` (input_fingerprints) are
+    reused, so those files are not read again.
+    """
+    def relative(file_path):
+        return Path(file_path).relative_to(data_folder).as_posix()
+    
+    unique_files, duplicates = [], []
+    first_by_digest = {}
+    for file_path in dcm_files:
+        digest = (inputs or {}).get(relative(file_path), {}).get('pixel_sha1')
+        if digest is None:
+            digest = pixel_data_digest(file_path)
+        if digest is None:
+            unique_files.append(file_path)
+        elif digest in first_by_digest:
+            duplicates.append({'file': relative(file_path), 'duplicate_of': relative(first_by_digest[digest])})
+        else:
+            first_by_digest[digest] = file_path
+            unique_files.append(file_path)
+    return unique_files, duplicates
+
+# Encapsulated pixel data item tags (little endian)
+_ITEM_TAG = b'\xfe\xff\x00\xe0'
+_SEQUENCE_DELIMITER_TAG = b'\xfe\xff\xdd\xe0'
+
+# JPEG 2000 / HTJ2K transfer syntaxes that can be decoded frame by frame
+JPEG2000_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2.4.90',   # JPEG 2000 Lossless
+    '1.2.840.10008.1.2.4.91',   # JPEG 2000
+    '1.2.840.10008.1.2.4.201',  # HTJ2K Lossless
+    '1.2.840.10008.1.2.4.202',  # HTJ2K Lossless RPCL
+    '1.2.840.10008.1.2.4.203',  # HTJ2K
+}
+
+def _transfer_syntax(dcm):
+    """Return the transfer syntax UID of a dataset as a string ('' if unknown)."""
+    file_meta = getattr(dcm, 'file_meta', None)
+    return str(getattr(file_meta, 'TransferSyntaxUID', '')) if file_meta is not None else ''
+
+def _pixel_dtype(dcm):
+    """NumPy dtype of the stored pixels (BitsAllocated + PixelRepresentation)."""
+    bits = int(getattr(dcm, 'BitsAllocated', 8))
+    signed = int(getattr(dcm, 'PixelRepresentation', 0)) == 1
+    return np.dtype(f"{'i' if signed else 'u'}{max(bits // 8, 1)}")
+
+def _scan_frame_fragments(fp, n_frames):
+    """
+    Walk the encapsulated PixelData items and locate each frame's fragments.
+    
+    fp must be positioned at the (7FE0,0010) element, i.e. at
+    len(header_bytes) from read_repaired_header. Only the item headers
+    are read; the compressed data is skipped over.
+    
+    Returns a list with one [(offset, length), ...] fragment list per frame.
+    """
+    header = fp.read(12)
+    explicit_vr = header[4:6] in (b'OB', b'OW')
+    if not explicit_vr:
+        fp.seek(-4, 1)
+    length = int.from_bytes(header[8:12] if explicit_vr else header[4:8], 'little')
+    if length != 0xFFFFFFFF:
+        raise ValueError("PixelData is not encapsulated")
+    
+    offset_table = None
+    fragments = []  # (item offset relative to first fragment, data offset, length)
+    first_item = None
+    while True:
+        item = fp.read(8)
+        if len(item) < 8 or item[:4] == _SEQUENCE_DELIMITER_TAG:
+            break
+        if item[:4] != _ITEM_TAG:
+            raise ValueError(f"Unexpected tag in encapsulated PixelData: {item[:4].hex()}")
+        item_length = int.from_bytes(item[4:8], 'little')
+        
+        if offset_table is None:
+            table = fp.read(item_length)
+            offset_table = [int.from_bytes(table[i:i + 4], 'little')
+                            for i in range(0, len(table) - 3, 4)]
+            continue
+        
+        position = fp.tell()
+        if first_item is None:
+            first_item = position - 8
+        fragments.append((position - 8 - first_item, position, item_length))
+        fp.seek(item_length, 1)
+    
+    if len(fragments) == n_frames:
+        return [[(pos, size)] for _, pos, size in fragments]
+    if n_frames == 1:
+        return [[(pos, size) for _, pos, size in fragments]]
+    if offset_table and len(offset_table) == n_frames:
+        # Basic Offset Table gives the item offset at which each frame starts
+        frames = []
+        bounds = offset_table + [float('inf')]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            frames.append([(pos, size) for item_offset, pos, size in fragments
+                           if start <= item_offset < end])
+        return frames
+    
+    raise ValueError(f"Cannot map {len(fragments)} fragments to {n_frames} frames")
+
+_J2K_DECODER = None  # (decode, parallel), resolved once by _j2k_decoder
+
+def _j2k_decoder():
+    """
+    The JPEG 2000 frame decoder and whether frames decode in parallel on threads.
+    
+    imagecodecs.jpeg2k_decode releases the GIL while OpenJPEG runs (and can
+    use several threads per frame). pylibjpeg-openjpeg's decode holds the
+    GIL and reads through a Python file object, so threads would only take
+    turns; it is used as a serial fallback when imagecodecs is missing.
+    The choice is made on the first call and reused for every frame.
+    """
+    global _J2K_DECODER
+    if _J2K_DECODER is None:
+        try:
+            from imagecodecs import jpeg2k_decode
+        except ImportError:
+            import openjpeg
+            _J2K_DECODER = (lambda codestream, numthreads=1: openjpeg.decode(codestream)), False
+        else:
+            _J2K_DECODER = (lambda codestream, numthreads=1:
+                            jpeg2k_decode(codestream, numthreads=numthreads)), True
+    return _J2K_DECODER
+
+def _decode_j2k(codestream, dtype, numthreads=1):
+    """Decode one JPEG 2000 frame and reinterpret it as the dataset's dtype."""
+    decode, _ = _j2k_decoder()
+    frame = decode(codestream, numthreads)
+    if frame.dtype != dtype and frame.dtype.itemsize == dtype.itemsize:
+        frame = frame.view(dtype)
+    return frame.astype(dtype, copy=False)
+
+class DicomFrameVolume:
+    """
+    Lazy, frame-by-frame reader for multi-frame JPEG 2000 DICOM volumes.
+    
+    Only the header and the fragment table are read on construction. Each
+    frame (a B-scan) is read from disk and decoded on demand: sampling and
+    the preview decode read single B-scans, and read_volume decodes every
+    frame once, straight into the preallocated (Y, X, Z) array or .npy
+    memmap. Peak memory is that one volume plus a frame per decoding
+    thread, instead of the several full-size copies made by
+    dcm.decompress() + pixel_array. Scoring still needs the whole volume,
+    so selection does not run on a rolling window of frames.
+    
+    The file is opened once per thread that reads frames (not once per
+    frame); close() releases the handles, read_volume does so when done.
+    
+    Frames are returned in the fixed (Y, X, Z) orientation, i.e. the
+    Columns/Frames swap handled by read_dicom_robust is applied per frame.
+    """
+    
+    def __init__(self, file_path):
+        self.file_path = Path(file_path)
+        
+        self.dcm, _, header = read_repaired_header(self.file_path)
+        if _transfer_syntax(self.dcm) not in JPEG2000_TRANSFER_SYNTAXES:
+            raise ValueError("Not a JPEG 2000 encoded dataset")
+        
+        self.n_frames = int(getattr(self.dcm, 'NumberOfFrames', 1) or 1)
+        with open(self.file_path, 'rb') as fp:
+            fp.seek(len(header))
+            self._fragments = _scan_frame_fragments(fp, self.n_frames)
+        
+        self._local = threading.local()
+        self._handles = []
+        self._handles_lock = threading.Lock()
+        
+        self.dtype = _pixel_dtype(self.dcm)
+        raw_shape = (self.n_frames, int(self.dcm.Rows), int(self.dcm.Columns))
+        self.swap_axes = needs_axis_swap(raw_shape)
+        self.raw_shape = raw_shape
+        self.shape = header_image_shape(self.dcm)
+    
+    def _handle(self):
+        """This thread's open file handle, opened on first use."""
+        fp = getattr(self._local, 'fp', None)
+        if fp is None or fp.closed:
+            fp = open(self.file_path, 'rb')
+            self._local.fp = fp
+            with self._handles_lock:
+                self._handles.append(fp)
+        return fp
+    
+    def close(self):
+        """Close the file handles opened by frame_bytes."""
+        with self._handles_lock:
+            for fp in self._handles:
+                fp.close()
+            self._handles = []
+    
+    def frame_bytes(self, index):
+        """Read the compressed codestream of one frame from disk."""
+        fp = self._handle()
+        parts = []
+        for offset, length in self._fragments[index]:
+            fp.seek(offset)
+            parts.append(fp.read(length))
+        return b''.join(parts)
+    
+    def decode_frame(self, index, numthreads=1):
+        """Decode one frame in file orientation (Rows, Columns)."""
+        return _decode_j2k(self.frame_bytes(index), self.dtype, numthreads)
+    
+    def bscan(self, index, numthreads=1):
+        """Decode B-scan `index` as an (X, Z) plane."""
+        frame = self.decode_frame(index, numthreads)
+        return frame.T if self.swap_axes else frame
+    
+    def iter_bscans(self, numthreads=1):
+        """Yield the B-scans (X, Z) one at a time, in Y order."""
+        for index in range(self.n_frames):
+            yield self.bscan(index, numthreads)
+    
+    def read_volume(self, out=None, threads=1):
+        """
+        Decode every frame straight into a (Y, X, Z) array.
+        
+        `out` may be any preallocated array of the right shape (including
+        an np.memmap); otherwise a new array is allocated. With threads > 1
+        and imagecodecs installed, frames are decoded on a thread pool
+        (jpeg2k_decode releases the GIL) and each thread writes its frame
+        into its own slice of `out`; a single-frame file uses OpenJPEG's own
+        threads instead. Without imagecodecs, frames are decoded serially
+        (see _j2k_decoder).
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        _, parallel = _j2k_decoder()
+        
+        def decode_into(index):
+            out[index] = self.bscan(index, 1 if self.n_frames > 1 else threads)
+        
+        try:
+            if parallel and threads > 1 and self.n_frames > 1:
+                with ThreadPoolExecutor(max_workers=threads) as executor:
+                    # list() re-raises the first decode error, if any
+                    list(executor.map(decode_into, range(self.n_frames)))
+            else:
+                for index, bscan in enumerate(self.iter_bscans(1 if self.n_frames > 1 else threads)):
+                    out[index] = bscan
+        finally:
+            self.close()
+        return out
+
+# Uncompressed transfer syntaxes whose PixelData can be memory-mapped as-is
+NATIVE_TRANSFER_SYNTAXES = {
+    '1.2.840.10008.1.2': '<',    # Implicit VR Little Endian
+    '1.2.840.10008.1.2.1': '<',  # Explicit VR Little Endian
+    '1.2.840.10008.1.2.2': '>',  # Explicit VR Big Endian (retired)
+}
+
+def read_dicom_memmap(file_path):
+    """
+    Zero-copy read of an uncompressed DICOM volume.
+    
+    Returns an np.memmap view over the PixelData bytes with the right shape,
+    dtype and axis order, so pages are only read from disk when a later
+    stage touches them. Raises ValueError for compressed or non-image files.
+    """
+    dcm, _, header = read_repaired_header(file_path)
+    element_offset = len(header)
+    with open(file_path, 'rb') as fp:
+        fp.seek(element_offset)
+        element_header = fp.read(12)
+    
+    byte_order = NATIVE_TRANSFER_SYNTAXES.get(_transfer_syntax(dcm))
+    if byte_order is None:
+        raise ValueError("Not an uncompressed transfer syntax")
+    if int(getattr(dcm, 'SamplesPerPixel', 1) or 1) != 1 or int(getattr(dcm, 'BitsAllocated', 8)) % 8:
+        raise ValueError("Unsupported pixel layout")
+    
+    # Explicit VR: tag, VR, 2 reserved bytes, 4-byte length; implicit VR: tag, 4-byte length
+    explicit_vr = element_header[4:6] in (b'OB', b'OW')
+    data_offset = element_offset + (12 if explicit_vr else 8)
+    
+    shape = header_image_shape(dcm)
+    frames = int(getattr(dcm, 'NumberOfFrames', 1) or 1)
+    raw_shape = (frames, int(dcm.Rows), int(dcm.Columns)) if frames > 1 else (int(dcm.Rows), int(dcm.Columns))
+    dtype = _pixel_dtype(dcm).newbyteorder(byte_order)
+    
+    image = np.memmap(file_path, dtype=dtype, mode='r', offset=data_offset, shape=raw_shape)
+    if needs_axis_swap(raw_shape):
+        print(f"  Detected dimension error: swapping X and Z axes")
+        print(f"    Original shape: {raw_shape} → Fixed shape: {shape}")
+        image = np.transpose(image, (0, 2, 1))
+    
+    return image, dcm
+
+def _is_memory_mapped(image):
+    """Check whether an array (or the array it is a view of) is an np.memmap."""
+    while image is not None:
+        if isinstance(image, np.memmap):
+            return True
+        image = getattr(image, 'base', None)
+    return False
+
+def read_dicom_robust(file_path, threads=1):
     """
     Robustly read Zeiss OCTA DICOM file with error handling.
     
@@ -98,7 +955,27 @@ def read_dicom_robust(file_path):
     - Corrupted metadata
     - JPEG 2000 compression
     - Dimension errors (Columns/Frames swapped)
+    
+    JPEG 2000 volumes are decoded frame by frame with DicomFrameVolume,
+    straight into the final (Y, X, Z) array, on `threads` threads.
+    Uncompressed files are
+    memory-mapped (read_dicom_memmap). Anything else falls back to
+    pydicom's full-dataset decompression.
     """
+    try:
+        volume = DicomFrameVolume(file_path)
+        if volume.swap_axes:
+            print(f"  Detected dimension error: swapping X and Z axes")
+            print(f"    Original shape: {volume.raw_shape} → Fixed shape: {volume.shape}")
+        return volume.read_volume(threads=threads), volume.dcm
+    except Exception:
+        pass
+    
+    try:
+        return read_dicom_memmap(file_path)
+    except Exception:
+        pass
+    
     try:
         dcm = pydicom.dcmread(str(file_path), force=True)
         
@@ -110,7 +987,8 @@ def read_dicom_robust(file_path):
         
         # Decompress (JPEG 2000)
         try:
-            dcm.decompress()
+            if _transfer_syntax(dcm) not in NATIVE_TRANSFER_SYNTAXES:
+                dcm.decompress()
             image = dcm.pixel_array
         except Exception as e:
             print(f"  Decompression failed: {e}")
@@ -118,14 +996,11 @@ def read_dicom_robust(file_path):
         
         # Check for dimension errors (common in Zeiss exports)
         # OCTA data should be (Y, X, Z) where Z (depth) is typically 1024
-        if len(image.shape) == 3:
-            # Ensure depth dimension (should be ~1024) is last
-            # If middle dimension is largest, transpose to move it to end
-            if image.shape[1] > image.shape[2] and image.shape[1] > image.shape[0]:
-                print(f"  Detected dimension error: swapping X and Z axes")
-                print(f"    Original shape: {image.shape} → ", end='')
-                image = np.transpose(image, (0, 2, 1))
-                print(f"Fixed shape: {image.shape}")
+        if needs_axis_swap(image.shape):
+            print(f"  Detected dimension error: swapping X and Z axes")
+            print(f"    Original shape: {image.shape} → ", end='')
+            image = np.transpose(image, (0, 2, 1))
+            print(f"Fixed shape: {image.shape}")
         
         return image, dcm
         
@@ -133,6 +1008,197 @@ def read_dicom_robust(file_path):
         print(f"  Read error: {e}")
         return None, None
 
+class VolumeCache:
+    """
+    Persistent on-disk cache of decoded volumes.
+    
+    Entries are the repaired, axis-fixed (Y, X, Z) arrays stored as .npy
+    files, keyed by the source file's size, mtime and a hash of its header
+    bytes. Hits are served with np.load(mmap_mode='r'), so re-runs skip
+    decompression entirely. The total size is capped; the least recently
+    used entries (by file mtime, refreshed on every hit) are evicted first.
+    """
+    
+    VERSION = 1  # bump to invalidate entries written by older versions
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+    
+    def _key(self, file_path):
+        """Return (cache key, repaired header dataset) for a DICOM file."""
+        stat = Path(file_path).stat()
+        dcm, _, header = read_repaired_header(file_path)
+        
+        digest = hashlib.sha1(header)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}:v{self.VERSION}".encode())
+        return digest.hexdigest(), dcm
+    
+    def get(self, file_path):
+        """Return (memory-mapped image, dcm) on a hit, else (None, None)."""
+        try:
+            key, dcm = self._key(file_path)
+            entry = self.cache_dir / f"{key}.npy"
+            if not entry.exists():
+                return None, None
+            image = np.load(entry, mmap_mode='r')
+            os.utime(entry)  # mark as recently used
+            return image, dcm
+        except Exception:
+            return None, None
+    
+    def put(self, file_path, image):
+        """Store a decoded volume, then evict old entries over the size cap."""
+        if image.nbytes > self.max_bytes:
+            return
+        try:
+            key, _ = self._key(file_path)
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entry = self.cache_dir / f"{key}.npy"
+            tmp_path = entry.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(image))
+            os.replace(tmp_path, entry)
+        except Exception as e:
+            print(f"  Warning: Could not write cache entry: {e}")
+            return
+        self.evict()
+    
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits max_bytes.
+        
+        Entries that cannot be removed are skipped: on Windows a file that
+        is still memory-mapped (e.g. a cache hit that is the current best
+        volume) cannot be deleted, and the next older entry goes instead.
+        """
+        entries = []
+        for entry in self.cache_dir.glob("*.npy"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        entries.sort(key=lambda item: item[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+            total -= size
+    
+    def clear(self):
+        """Delete every cache entry (except ones in use). Returns the number removed."""
+        if not self.cache_dir.exists():
+            return 0
+        removed = 0
+        for entry in list(self.cache_dir.glob("*.npy")) + list(self.cache_dir.glob("*.tmp")):
+            try:
+                entry.unlink()
+            except OSError:
+                print(f"  Warning: Could not remove {entry.name} (in use)")
+                continue
+            removed += 1
+        return removed
+
+def read_dicom_cached(file_path, cache=None, threads=1):
+    """read_dicom_robust with an optional VolumeCache in front of it."""
+    if cache is not None:
+        image, dcm = cache.get(file_path)
+        if image is not None:
+            print(f"  Loaded from cache")
+            return image, dcm
+    
+    image, dcm = read_dicom_robust(file_path, threads)
+    # Memory-mapped (uncompressed) files are already free to re-read
+    if cache is not None and image is not None and not _is_memory_mapped(image):
+        cache.put(file_path, image)
+    return image, dcm
+
+def _read_dicom_worker(file_path, threads=1):
+    """
+    Process pool entry point for read_dicom_robust.
+    
+    PixelData is dropped from the returned dataset: the decoded image is
+    already sent back, so pickling the compressed bytes again is wasted work.
+    """
+    image, dcm = read_dicom_robust(file_path, threads)
+    if dcm is not None and 'PixelData' in dcm:
+        del dcm.PixelData
+    return image, dcm
+
+def read_dicom_files(dcm_files, workers=1, cache=None, threads=1):
+    """
+    Read all DICOM files, optionally on a process pool.
+    
+    JPEG 2000 decoding is CPU-bound, so with workers > 1 the files are
+    decoded in parallel. Results are yielded as (file_path, image, dcm) in
+    the same order as dcm_files, so volume selection is identical to a
+    serial run. Cache hits and uncompressed (memory-mapped) files are
+    served in this process; only files that need decoding are sent to the
+    pool, and their results are cached here. `threads` is the number of
+    frame-decoding threads used inside each file.
+    """
+    if workers == 0:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(dcm_files))
+    
+    total = len(dcm_files)
+    
+    if workers <= 1:
+        for i, file_path in enumerate(dcm_files, 1):
+            print(f"\n[{i}/{total}] {file_path.name}")
+            image, dcm = read_dicom_cached(file_path, cache, threads)
+            yield file_path, image, dcm
+            # Do not keep this volume alive while the next file decodes
+            del image, dcm
+        return
+    
+    def submit(executor, file_path):
+        image, dcm = cache.get(file_path) if cache is not None else (None, None)
+        if image is not None:
+            return 'cache', (image, dcm)
+        header = read_dicom_header(file_path)
+        if header is not None and _transfer_syntax(header) in NATIVE_TRANSFER_SYNTAXES:
+            return 'local', None
+        return 'pool', executor.submit(_read_dicom_worker, file_path, threads)
+    
+    def collect(i, file_path, source, result):
+        print(f"\n[{i}/{total}] {file_path.name}")
+        if source == 'cache':
+            print(f"  Loaded from cache")
+            image, dcm = result
+        elif source == 'local':
+            image, dcm = read_dicom_robust(file_path)
+        else:
+            image, dcm = result.result()
+            if cache is not None and image is not None:
+                cache.put(file_path, image)
+        return file_path, image, dcm
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep at most `workers` decodes in flight so finished volumes do not
+        # pile up in memory ahead of the consumer
+        pending = deque()
+        for i, file_path in enumerate(dcm_files, 1):
+            pending.append((i, file_path) + submit(executor, file_path))
+            if len(pending) > workers:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
+
+def iter_volumes(dcm_files, workers=1, cache=None, threads=1):
+    """Yield (image, dcm, file_path) for every file that could be read."""
+    for file_path, image, dcm in read_dicom_files(dcm_files, workers, cache, threads):
+        if image is None:
+            continue
+        print(f"  ✓ Shape: {image.shape}, Dtype: {image.dtype}")
+        yield image, dcm, file_path
+        del image, dcm
+
 def calculate_voxel_size(image_shape):
     """
     Calculate voxel size based on image dimensions.
@@ -178,85 +1244,1895 @@ def calculate_voxel_size(image_shape):
     
     return voxel_x, voxel_y, voxel_z, scan_width_mm, scan_depth_mm
 
-def select_best_volume(all_data):
+def volume_range(img, block_frames=16):
     """
-    Select the best volume from multiple files.
+    Min and max of a volume in one chunked pass.
     
-    For OCTA angiography, look for:
-    - Proper 3D volume (not 2D slices)
-    - Good contrast (not too uniform)
-    - Clear vessel signal
+    Each block of `block_frames` B-scans is reduced for both min and max
+    while it is still in cache, instead of two full passes over the volume.
     """
-    # Group by shape
-    shape_groups = {}
-    for img, dcm, name in all_data:
-        if len(img.shape) != 3:
-            continue
-        shape = img.shape
-        if shape not in shape_groups:
-            shape_groups[shape] = []
-        shape_groups[shape].append((img, dcm, name))
-    
-    if not shape_groups:
-        return None, None, None
+    lo = hi = None
+    for start in range(0, img.shape[0], block_frames):
+        block = img[start:start + block_frames]
+        block_lo, block_hi = block.min(), block.max()
+        lo = block_lo if lo is None else min(lo, block_lo)
+        hi = block_hi if hi is None else max(hi, block_hi)
+    return lo, hi
+
+def _normalization_lut(dtype, lo, span):
+    """
+    256/65536-entry lookup table mapping every value of an 8/16-bit integer
+    dtype to uint8, with the same float32 arithmetic as the block path.
+    Index the table with the data viewed as the unsigned dtype of the same size.
+    """
+    unsigned = np.dtype(f'u{dtype.itemsize}')
+    values = np.arange(2 ** (8 * dtype.itemsize), dtype=np.uint32).astype(unsigned).view(dtype)
+    lut = values.astype(np.float32)
+    lut -= lo
+    lut /= span
+    lut *= 255
+    np.clip(lut, 0, 255, out=lut)  # entries outside [lo, hi] are never used
+    return lut.astype(np.uint8), unsigned
+
+def normalize_to_uint8(img, value_range=None, block_frames=16, out=None):
+    """
+    Normalization engine: min/max scale a non-int8 volume to uint8.
     
-    # Select most common shape
-    target_shape, matching_files = max(shape_groups.items(), key=lambda x: len(x[1]))
+    Min and max come from a single chunked pass (volume_range) unless
+    value_range is given. 8/16-bit integer data is mapped through a
+    precomputed lookup table; other data (float, 32-bit) is scaled in place
+    on a float32 (float64 for float64 input) copy of one block at a time. Temporary memory is bounded
+    to `block_frames` B-scans either way. `out` may be a preallocated
+    uint8 array (e.g. an .npy memmap) to write into.
+    """
+    lo, hi = value_range if value_range is not None else volume_range(img, block_frames)
+    lo, span = float(lo), float(hi) - float(lo)
+    img_uint8 = out if out is not None else np.empty(img.shape, dtype=np.uint8)
+    if span == 0:
+        img_uint8.fill(0)
+        return img_uint8
     
-    print(f"\nFound {len(matching_files)} files with shape {target_shape}")
+    lut = None
+    if img.dtype.kind in 'iu' and img.dtype.itemsize <= 2:
+        lut, unsigned = _normalization_lut(img.dtype, lo, span)
+    work_dtype = np.float64 if img.dtype == np.float64 else np.float32
     
-    # Analyze each file
-    print("\nAnalyzing files:")
-    scores = []
-    for i, (img, dcm, name) in enumerate(matching_files, 1):
-        # Convert to uint8
-        if img.dtype == np.int8:
-            img_uint8 = img.astype(np.int16) + 128
-            img_uint8 = img_uint8.astype(np.uint8)
+    for start in range(0, img.shape[0], block_frames):
+        block = img[start:start + block_frames]
+        if lut is not None:
+            np.take(lut, block.view(unsigned), out=img_uint8[start:start + block_frames])
         else:
-            img_uint8 = ((img.astype(np.float32) - img.min()) / 
-                        (img.max() - img.min()) * 255).astype(np.uint8)
-        
-        # Calculate quality metrics
-        mean_val = img.mean()
-        std_val = img.std()
-        
-        # MIP analysis
-        mip_z = np.max(img_uint8, axis=2)
-        contrast = mip_z.std()
-        
-        # Score: prefer good contrast and reasonable mean
-        score = contrast
-        
-        print(f"  File {i}: {name}")
-        print(f"    Mean: {mean_val:.1f}, Std: {std_val:.1f}, Contrast: {contrast:.1f}")
-        
-        scores.append((score, img, dcm, name))
+            block = block.astype(work_dtype)
+            block -= lo
+            block /= span
+            block *= 255
+            img_uint8[start:start + block_frames] = block
+    return img_uint8
+
+def to_uint8(img, inplace=False, value_range=None, block_frames=16, out=None):
+    """
+    Intensity conversion engine: any decoded volume to uint8 [0, 255].
     
-    # Select best
-    scores.sort(key=lambda x: x[0], reverse=True)
-    _, best_img, best_dcm, best_name = scores[0]
+    - int8 is shifted by +128, which for two's complement is just flipping
+      the sign bit of the same bytes: with inplace=True the array's own
+      buffer is reused as a uint8 view (zero copy), otherwise a single
+      uint8 copy is made. No int16 temporary is needed either way.
+    - Other dtypes, uint8 included, are min/max normalized by
+      normalize_to_uint8 (through a 256-entry table for uint8; with
+      inplace=True the uint8 array is rescaled in its own buffer).
     
-    print(f"\nSelected: {best_name} (highest contrast)")
+    value_range=(min, max) skips the min/max pass when already known.
+    `out` (a preallocated uint8 array) receives the result instead of a
+    new array; inplace is ignored then.
+    """
+    if img.dtype == np.uint8 and inplace and out is None and img.flags.writeable:
+        out = img
+    
+    if img.dtype == np.int8:
+        if out is not None:
+            return np.bitwise_xor(img.view(np.uint8), np.uint8(0x80), out=out)
+        if inplace and img.flags.writeable:
+            img_uint8 = img.view(np.uint8)
+            img_uint8 ^= 0x80
+            return img_uint8
+        return np.bitwise_xor(img.view(np.uint8), np.uint8(0x80))
     
-    return best_img, best_dcm, best_name
+    return normalize_to_uint8(img, value_range, block_frames, out)
 
-def main():
-    if len(sys.argv) < 2:
-        print("\n" + "="*80)
-        print("Zeiss Cirrus OCTA DICOM to TIFF Converter")
-        print("="*80)
-        print("\nUsage: python Zeiss_OCTA_Converter.py <folder_name>")
-        print("\nExample: python Zeiss_OCTA_Converter.py HenkE433")
-        print("\nThe script will:")
-        print("  1. Read all DICOM files in the folder")
-        print("  2. Fix corrupted metadata and decompress JPEG 2000")
+# Projections of a (Y, X, Z) uint8 volume, computed together by compute_projections
+PROJECTIONS = ('max_z', 'max_y', 'max_x', 'mean_z', 'sum_z', 'histogram')
+DEFAULT_PROJECTIONS = ('max_z', 'max_y', 'max_x', 'histogram')
+
+def compute_projections(img_uint8, kinds=DEFAULT_PROJECTIONS, block_frames=16):
+    """
+    Compute several projections of a uint8 volume in one blocked pass.
+    
+    kinds is a subset of PROJECTIONS: max_z (en-face MIP, Y x X), max_y
+    (X x Z), max_x (Y x Z), sum_z / mean_z (en-face sum and mean over
+    depth) and histogram (256 bins). The volume is read block_frames
+    B-scans at a time and every requested projection is filled from the
+    same block. Returns {kind: array}.
+    """
+    unknown = [kind for kind in kinds if kind not in PROJECTIONS]
+    if unknown:
+        raise ValueError(f"Unknown projection(s): {', '.join(unknown)}")
+    ny, nx, nz = img_uint8.shape
+    result = {}
+    if 'max_z' in kinds:
+        result['max_z'] = np.empty((ny, nx), dtype=np.uint8)
+    if 'max_y' in kinds:
+        result['max_y'] = np.zeros((nx, nz), dtype=np.uint8)
+    if 'max_x' in kinds:
+        result['max_x'] = np.empty((ny, nz), dtype=np.uint8)
+    sum_z = np.empty((ny, nx), dtype=np.uint32) if 'sum_z' in kinds or 'mean_z' in kinds else None
+    hist = np.zeros(256, dtype=np.int64) if 'histogram' in kinds else None
+    
+    for start in range(0, ny, block_frames):
+        rows = slice(start, start + block_frames)
+        block = img_uint8[rows]
+        if 'max_z' in kinds:
+            np.max(block, axis=2, out=result['max_z'][rows])
+        if 'max_x' in kinds:
+            np.max(block, axis=1, out=result['max_x'][rows])
+        if 'max_y' in kinds:
+            np.maximum(result['max_y'], block.max(axis=0), out=result['max_y'])
+        if sum_z is not None:
+            np.sum(block, axis=2, dtype=np.uint32, out=sum_z[rows])
+        if hist is not None:
+            hist += np.bincount(block.reshape(-1), minlength=256)
+    
+    if 'sum_z' in kinds:
+        result['sum_z'] = sum_z
+    if 'mean_z' in kinds:
+        result['mean_z'] = (sum_z / max(nz, 1)).astype(np.float32)
+    if hist is not None:
+        result['histogram'] = hist
+    return result
+
+def histogram_statistics(hist):
+    """min, max, mean and std of uint8 intensities from a 256-bin histogram."""
+    levels = np.arange(256)
+    total = hist.sum()
+    present = np.flatnonzero(hist)
+    mean = np.dot(levels, hist) / total
+    return {
+        'min': int(present[0]),
+        'max': int(present[-1]),
+        'mean': float(mean),
+        'std': float(np.sqrt(np.dot((levels - mean) ** 2, hist) / total)),
+    }
+
+class OCTAVolume:
+    """
+    A selected (Y, X, Z) volume and its uint8 form.
+    
+    The uint8 conversion is done once (see to_uint8) and then shared by
+    scoring and every writer (.npy, TIFF, NIfTI, preview). When the decoded
+    array is private and writable, int8 data is converted in place, so the
+    uint8 volume replaces the decoded one instead of sitting next to it.
+    Projections (MIPs, histogram) are cached the same way, see projections().
+    
+    `path` is the full path of the source file: DICOMDIR series folders
+    reuse file names (SE000000/IM000000, SE000001/IM000000, ...), so `name`
+    is for messages only and never identifies the file.
+    """
+    
+    def __init__(self, image, dcm=None, path=None):
+        self.dcm = dcm
+        self.path = Path(path) if path is not None else None
+        self.name = self.path.name if path is not None else None
+        self.shape = image.shape
+        self.source_dtype = image.dtype
+        self._image = image
+        self._uint8 = None
+        self._source_range = None
+        self._projections = {}
+    
+    @classmethod
+    def from_uint8(cls, volume_uint8, source_dtype, dcm=None, path=None, source_range=None):
+        """Wrap an already converted uint8 volume (e.g. decoded into an .npy)."""
+        volume = cls(volume_uint8, dcm, path)
+        volume.source_dtype = np.dtype(source_dtype)
+        volume._image = None
+        volume._uint8 = volume_uint8
+        volume._source_range = source_range
+        return volume
+    
+    def write_npy(self, npy_path):
+        """
+        Make the uint8 volume an .npy file and continue from its memmap.
+        
+        The file is created with np.lib.format.open_memmap and filled by the
+        uint8 conversion itself (or, if the conversion was already done, by
+        a blocked copy), after which the private array is released. All
+        writers then read from the mapped file, so the uint8 volume is not
+        held in RAM twice.
+        """
+        npy_path = Path(npy_path)
+        if isinstance(self._uint8, np.memmap) and Path(self._uint8.filename) == npy_path.resolve():
+            self._uint8.flush()
+            return self._uint8
+        
+        npy = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.uint8, shape=self.shape)
+        if self._uint8 is None:
+            image = self._image
+            if image.dtype != np.int8 and self._source_range is None:
+                self._source_range = volume_range(image)
+            to_uint8(image, value_range=self._source_range, out=npy)
+            self._image = None
+        else:
+            for start in range(0, self.shape[0], 16):
+                npy[start:start + 16] = self._uint8[start:start + 16]
+        npy.flush()
+        self._uint8 = npy
+        return npy
+    
+    @property
+    def uint8(self):
+        """The uint8 volume, converted on first access."""
+        if self._uint8 is None:
+            image = self._image
+            if image.dtype != np.int8 and self._source_range is None:
+                self._source_range = volume_range(image)
+            inplace = image.flags.writeable and not _is_memory_mapped(image)
+            self._uint8 = to_uint8(image, inplace=inplace, value_range=self._source_range)
+            self._image = None
+        return self._uint8
+    
+    def projections(self, kinds=DEFAULT_PROJECTIONS):
+        """
+        Projections of the uint8 volume (see compute_projections), memoized.
+        
+        Kinds not cached yet are computed together in one blocked pass, so
+        scoring, preview and metadata statistics share a single traversal.
+        The cache is not locked: fill it before starting concurrent writers.
+        """
+        missing = [kind for kind in kinds if kind not in self._projections]
+        if missing:
+            self._projections.update(compute_projections(self.uint8, missing))
+        return {kind: self._projections[kind] for kind in kinds}
+    
+    @property
+    def source_range(self):
+        """(min, max) of the decoded values, before uint8 conversion."""
+        if self._source_range is None:
+            if self._image is not None:
+                self._source_range = volume_range(self._image)
+            elif self.source_dtype == np.int8:
+                self._source_range = (int(self._uint8.min()) - 128, int(self._uint8.max()) - 128)
+            else:
+                self._source_range = (self._uint8.min(), self._uint8.max())
+        return self._source_range
+
+# Volume quality metrics, registered by name for select_best_volume / --score
+SCORING_METRICS = {}
+
+def register_metric(name):
+    """Class decorator adding a ScoringMetric subclass to SCORING_METRICS."""
+    def decorator(cls):
+        cls.name = name
+        SCORING_METRICS[name] = cls
+        return cls
+    return decorator
+
+class ScoringMetric:
+    """
+    Base class for volume quality metrics.
+    
+    score_volume builds the en-face MIP and the intensity histogram once, in
+    one blocked pass over the uint8 volume, and every metric is computed from
+    them by result(). `direction` is +1 if higher is better, -1 if lower is.
+    """
+    name = None
+    label = None
+    direction = 1
+    
+    def result(self, mip_z, hist):
+        raise NotImplementedError
+
+@register_metric('contrast')
+class MIPContrastMetric(ScoringMetric):
+    """Std of the en-face MIP (default selection score)."""
+    label = 'Contrast'
+    
+    def result(self, mip_z, hist):
+        return mip_z.std()
+
+@register_metric('vessels')
+class VesselPixelMetric(ScoringMetric):
+    """Number of MIP pixels above 180 (score of OCTA_DICOM2IMARIS.py)."""
+    label = 'Vessel pixels'
+    threshold = 180
+    
+    def result(self, mip_z, hist):
+        return int(np.count_nonzero(mip_z > self.threshold))
+
+@register_metric('mean')
+class MeanMetric(ScoringMetric):
+    """Mean uint8 intensity."""
+    label = 'Mean'
+    
+    def result(self, mip_z, hist):
+        return float(np.dot(np.arange(256), hist) / hist.sum())
+
+@register_metric('std')
+class StdMetric(ScoringMetric):
+    """Std of the uint8 intensity."""
+    label = 'Std'
+    
+    def result(self, mip_z, hist):
+        levels = np.arange(256)
+        mean = np.dot(levels, hist) / hist.sum()
+        return float(np.sqrt(np.dot((levels - mean) ** 2, hist) / hist.sum()))
+
+@register_metric('entropy')
+class EntropyMetric(ScoringMetric):
+    """Shannon entropy (bits) of the intensity histogram."""
+    label = 'Entropy'
+    
+    def result(self, mip_z, hist):
+        p = hist[hist > 0] / hist.sum()
+        return float(-(p * np.log2(p)).sum())
+
+@register_metric('motion')
+class MotionMetric(ScoringMetric):
+    """
+    Mean absolute difference between neighbouring rows of the en-face MIP.
+    
+    Each MIP row is the projection of one B-scan, so eye motion between
+    B-scans shows up as line artefacts (jumps between rows); lower is better.
+    """
+    label = 'Motion'
+    direction = -1
+    
+    def result(self, mip_z, hist):
+        if mip_z.shape[0] < 2:
+            return 0.0
+        return float(np.abs(np.diff(mip_z.astype(np.int16), axis=0)).mean())
+
+def parse_score_spec(spec):
+    """
+    Parse a --score value such as 'contrast' or 'contrast,vessels:0.01'.
+    
+    Returns a list of (metric name, weight). Raises ValueError on unknown
+    metrics or bad weights.
+    """
+    weights = []
+    for part in spec.split(','):
+        name, _, weight = part.strip().partition(':')
+        if name not in SCORING_METRICS:
+            raise ValueError(f"unknown metric '{name}' (available: {', '.join(SCORING_METRICS)})")
+        weights.append((name, float(weight) if weight else 1.0))
+    return weights
+
+def score_volume(img_uint8, metric_names, block_frames=16, projections=None):
+    """
+    Compute several metrics in one blocked pass over a uint8 volume.
+    
+    The en-face MIP (max over Z) and the 256-bin histogram are filled block
+    by block (compute_projections) and every metric is computed from them;
+    results are returned as {name: value}. projections may hold already
+    computed 'max_z' and 'histogram' (OCTAVolume.projections); then the
+    volume is not traversed again.
+    """
+    metrics = [SCORING_METRICS[name]() for name in metric_names]
+    projections = dict(projections or {})
+    missing = [kind for kind in ('max_z', 'histogram') if kind not in projections]
+    
+    if missing:
+        projections.update(compute_projections(img_uint8, missing, block_frames))
+    
+    return {metric.name: metric.result(projections['max_z'], projections['histogram'])
+            for metric in metrics}
+
+def combined_score(values, weights):
+    """Weighted sum of metric values, signed so that higher is always better."""
+    return sum(weight * SCORING_METRICS[name].direction * values[name] for name, weight in weights)
+
+def select_best_volume(all_data, score_weights=None):
+    """
+    Select the best volume from multiple files.
+    
+    For OCTA angiography, look for:
+    - Proper 3D volume (not 2D slices)
+    - Good contrast (not too uniform)
+    - Clear vessel signal
+    
+    all_data may be a list or a generator of (image, dcm, file_path). Volumes are
+    scored as they arrive and only the best one per 3D shape is kept, next
+    to a per-shape file count. After the header pre-scan there is a single
+    shape, so memory stays at about two volumes regardless of folder size.
+    The most common shape wins (first seen on ties), then the highest score
+    within it (first seen on ties), exactly as when grouping everything up
+    front.
+    
+    score_weights is a list of (metric name, weight) from parse_score_spec;
+    the default is MIP contrast alone. All metrics (plus the mean/std/
+    contrast shown in the log) come from the volume's projections, computed
+    in one pass and kept on it, so the winner's preview and metadata
+    statistics need no further traversal.
+    
+    Returns the selected OCTAVolume (its uint8 form is already computed),
+    or None.
+    """
+    score_weights = score_weights or [('contrast', 1.0)]
+    metric_names = ['mean', 'std', 'contrast']
+    metric_names += [name for name, _ in score_weights if name not in metric_names]
+
+    shape_counts = {}
+    best_by_shape = {}  # shape -> (score, OCTAVolume)
+    n_volumes = 0
+    
+    for img, dcm, file_path in all_data:
+        n_volumes += 1
+        shape = img.shape
+        if len(shape) != 3:
+            continue
+        shape_counts[shape] = shape_counts.get(shape, 0) + 1
+        
+        # Quality metrics, all from one pass over the shared uint8 conversion
+        volume = OCTAVolume(img, dcm, file_path)
+        del img
+        values = score_volume(volume.uint8, metric_names, projections=volume.projections())
+        score = combined_score(values, score_weights)
+        
+        # Report mean in the units of the decoded data (int8 is offset by 128)
+        mean_val = values['mean'] - 128 if volume.source_dtype == np.int8 else values['mean']
+        print(f"  File {n_volumes}: {volume.name}")
+        print(f"    Mean: {mean_val:.1f}, Std: {values['std']:.1f}, Contrast: {values['contrast']:.1f}")
+        extra = metric_names[3:]
+        if extra:
+            print("    " + ", ".join(f"{SCORING_METRICS[name].label}: {values[name]:.1f}" for name in extra))
+        
+        if shape not in best_by_shape or score > best_by_shape[shape][0]:
+            best_by_shape[shape] = (score, volume)
+        # Drop our reference right away so a losing volume can be freed
+        del volume
+    
+    if n_volumes == 0:
+        print("\nERROR: No valid volumes could be read!")
+        return None
+    
+    print(f"\n{'='*80}")
+    print(f"Successfully read {n_volumes} volumes")
+    print('='*80)
+    
+    if not shape_counts:
+        return None
+    
+    # Select most common shape
+    target_shape = max(shape_counts, key=lambda shape: shape_counts[shape])
+    _, best = best_by_shape[target_shape]
+    
+    print(f"\nFound {shape_counts[target_shape]} files with shape {target_shape}")
+    if score_weights == [('contrast', 1.0)]:
+        print(f"\nSelected: {best.name} (highest contrast)")
+    else:
+        spec = ', '.join(f"{name}×{weight:g}" for name, weight in score_weights)
+        print(f"\nSelected: {best.name} (highest score: {spec})")
+    
+    return best
+
+def mip_contrast(img):
+    """Contrast score used for volume selection: std of the uint8 en-face MIP."""
+    mip_z = np.max(to_uint8(img), axis=2)
+    return mip_z.std()
+
+def _preview_bscans(file_path, factor):
+    """(generator of every `factor`-th B-scan, dcm), or (None, None) if unreadable."""
+    try:
+        volume = DicomFrameVolume(file_path)
+        return (volume.bscan(y) for y in range(0, volume.n_frames, factor)), volume.dcm
+    except Exception:
+        image, dcm = read_dicom_robust(file_path)
+        if image is None or image.ndim != 3:
+            return None, None
+        return (image[y] for y in range(0, image.shape[0], factor)), dcm
+
+def preview_score(file_path, factor=4, score_weights=None):
+    """
+    Selection score of a volume estimated from every `factor`-th B-scan.
+    
+    The default (MIP contrast alone) streams the B-scans through
+    preview_mip_contrast. Other --score specs need the histogram and the
+    per-metric results, so the sampled B-scans are stacked (1/factor of
+    the volume) and scored with score_volume, min/max coming from the
+    subset as in preview_mip_contrast.
+    
+    Returns (score, dcm), or (None, None) if the file cannot be read.
+    """
+    if not score_weights or score_weights == [('contrast', 1.0)]:
+        return preview_mip_contrast(file_path, factor)
+    
+    bscans, dcm = _preview_bscans(file_path, factor)
+    if bscans is None:
+        return None, None
+    subset = np.stack(list(bscans))
+    names = [name for name, _ in score_weights]
+    return combined_score(score_volume(to_uint8(subset), names), score_weights), dcm
+
+def preview_mip_contrast(file_path, factor=4):
+    """
+    MIP contrast of a volume estimated from every `factor`-th B-scan.
+    
+    pylibjpeg-openjpeg cannot decode reduced J2K resolution levels, so the
+    cheap preview decodes a 1/factor subset of the frames instead. The
+    metric is the same as mip_contrast: both the int8 offset and min/max
+    normalization are monotonic, so the MIP is taken on the raw values and
+    converted afterwards (for non-int8 data, min/max come from the subset).
+    
+    Returns (contrast, dcm), or (None, None) if the file cannot be read.
+    """
+    bscans, dcm = _preview_bscans(file_path, factor)
+    if bscans is None:
+        return None, None
+    
+    mip_rows = []
+    lo, hi = None, None
+    for bscan in bscans:
+        mip_rows.append(bscan.max(axis=1))
+        b_lo, b_hi = bscan.min(), bscan.max()
+        lo = b_lo if lo is None else min(lo, b_lo)
+        hi = b_hi if hi is None else max(hi, b_hi)
+    mip_z = np.stack(mip_rows)
+    
+    mip_uint8 = to_uint8(mip_z, value_range=(lo, hi))
+    
+    return mip_uint8.std(), dcm
+
+def decode_selected_volume(file_path, cache=None, threads=1, npy_path=None):
+    """
+    Fully decode the selected file as an OCTAVolume.
+    
+    With npy_path, 8-bit JPEG 2000 volumes are decoded frame by frame
+    straight into the .npy file (np.lib.format.open_memmap) and converted
+    to uint8 there in place, so the decoded volume never exists in RAM.
+    Otherwise (cache hit, other formats) the volume is read as usual and
+    OCTAVolume.write_npy converts it into the file later.
+    """
+    file_path = Path(file_path)
+    if npy_path is not None and (cache is None or cache.get(file_path)[0] is None):
+        try:
+            frames = DicomFrameVolume(file_path)
+            if frames.dtype in (np.int8, np.uint8):
+                npy = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.uint8, shape=frames.shape)
+                decoded = npy.view(frames.dtype)
+                frames.read_volume(out=decoded, threads=threads)
+                if cache is not None:
+                    cache.put(file_path, decoded)
+                source_range = volume_range(decoded) if frames.dtype == np.uint8 else None
+                to_uint8(decoded, inplace=True, value_range=source_range)
+                npy.flush()
+                return OCTAVolume.from_uint8(npy, frames.dtype, frames.dcm, file_path, source_range)
+        except Exception:
+            pass
+    
+    image, dcm = read_dicom_cached(file_path, cache, threads)
+    if image is None:
+        return None
+    return OCTAVolume(image, dcm, file_path)
+
+def select_best_volume_preview(candidates, factor=4, cache=None, threads=1, npy_path=None,
+                               score_weights=None, target_shape=None):
+    """
+    Select the best volume from a preview decode, then fully decode the winner.
+    
+    candidates are the files main has kept: with the header pre-scan, the
+    majority-shape group (target_shape); without it (--no-prescan), every
+    file, and the majority 3D shape among the scored files is chosen here,
+    as select_best_volume does. Each is scored with preview_score (1/factor
+    of its frames, score_weights as for select_best_volume); only the
+    highest-scoring file is decompressed completely (into npy_path, if
+    given; see decode_selected_volume). Returns an OCTAVolume or None.
+    """
+    score_weights = score_weights or [('contrast', 1.0)]
+    contrast_only = score_weights == [('contrast', 1.0)]
+    if not candidates:
+        return None
+    
+    if target_shape is not None:
+        print(f"\nFound {len(candidates)} files with shape {target_shape}")
+    print(f"\nAnalyzing files (preview decode, 1/{factor} of B-scans):")
+    scores = []
+    for i, file_path in enumerate(candidates, 1):
+        score, dcm = preview_score(file_path, factor, score_weights)
+        shape = header_image_shape(dcm) if dcm is not None else None
+        if score is None or shape is None or len(shape) != 3:
+            continue
+        print(f"  File {i}: {file_path.name}")
+        print(f"    {'Contrast' if contrast_only else 'Score'} (preview): {score:.1f}")
+        scores.append((score, file_path, shape))
+    
+    if not scores:
+        return None
+    
+    if target_shape is None:
+        target_shape = _majority_shape([shape for _, _, shape in scores])
+        scores = [entry for entry in scores if entry[2] == target_shape]
+        print(f"\nFound {len(scores)} files with shape {target_shape}")
+    
+    scores.sort(key=lambda x: x[0], reverse=True)
+    best_file = scores[0][1]
+    
+    if contrast_only:
+        print(f"\nSelected: {best_file.name} (highest contrast)")
+    else:
+        spec = ', '.join(f"{name}×{weight:g}" for name, weight in score_weights)
+        print(f"\nSelected: {best_file.name} (highest score: {spec})")
+    print("Decoding full volume...")
+    return decode_selected_volume(best_file, cache, threads, npy_path)
+
+def _majority_shape(shapes):
+    """Most common shape in a list (first seen wins ties), as in select_best_volume."""
+    counts = {}
+    for shape in shapes:
+        counts[shape] = counts.get(shape, 0) + 1
+    return max(counts, key=lambda shape: counts[shape])
+
+def _ranking_agreement(scores_a, scores_b):
+    """
+    Fraction of candidate pairs ordered the same way by two score lists.
+    
+    A pair tied in both lists (e.g. duplicate volumes) agrees; a pair tied
+    in only one of them does not.
+    """
+    pairs = concordant = 0
+    for i in range(len(scores_a)):
+        for j in range(i + 1, len(scores_a)):
+            pairs += 1
+            if np.sign(scores_a[i] - scores_a[j]) == np.sign(scores_b[i] - scores_b[j]):
+                concordant += 1
+    return concordant / pairs if pairs else 1.0
+
+def preview_ranking_report(exam_folders, factor=4):
+    """
+    Compare preview-decode rankings with full-decode rankings.
+    
+    For every exam folder, all majority-shape candidates are scored both ways.
+    Prints per-exam whether the selected file matches and the fraction of
+    candidate pairs ranked in the same order, followed by a corpus summary.
+    """
+    top1_matches = 0
+    agreements = []
+    
+    for folder in exam_folders:
+        dcm_files, index = enumerate_dicom_files(folder)
+        candidates, _ = prescan_headers(dcm_files, index)
+        
+        names, full_scores, preview_scores = [], [], []
+        for file_path in candidates:
+            image, _ = read_dicom_robust(file_path)
+            preview, _ = preview_mip_contrast(file_path, factor)
+            if image is None or preview is None:
+                continue
+            names.append(file_path.relative_to(folder).as_posix())
+            full_scores.append(mip_contrast(image))
+            preview_scores.append(preview)
+        
+        if not names:
+            print(f"  {folder.name}: no candidate volumes")
+            continue
+        
+        best_full = names[int(np.argmax(full_scores))]
+        best_preview = names[int(np.argmax(preview_scores))]
+        agreement = _ranking_agreement(full_scores, preview_scores)
+        top1_matches += best_full == best_preview
+        agreements.append(agreement)
+        
+        status = "match" if best_full == best_preview else f"MISMATCH (full: {best_full})"
+        print(f"  {folder.name}: {len(names)} candidates, selected {best_preview} - {status}, "
+              f"pairwise agreement {agreement:.0%}")
+    
+    if agreements:
+        print(f"\nPreview 1/{factor}: selection agrees in {top1_matches}/{len(agreements)} exams, "
+              f"mean pairwise agreement {np.mean(agreements):.0%}")
+
+def _uint8_levels(dtype, lo, hi):
+    """
+    Lookup table giving the uint8 value of every level of an 8/16-bit dtype,
+    as to_uint8 would convert it for a volume with range [lo, hi].
+    Index it with the data viewed as the returned unsigned dtype.
+    """
+    unsigned = np.dtype(f'u{dtype.itemsize}')
+    levels = np.arange(2 ** (8 * dtype.itemsize), dtype=np.uint32).astype(unsigned)
+    if dtype == np.int8:
+        return levels ^ np.uint8(0x80), unsigned
+    if hi == lo:
+        return np.zeros(len(levels), dtype=np.uint8), unsigned
+    return _normalization_lut(dtype, float(lo), float(hi) - float(lo))
+
+def _open_bscans(file_path, cache=None, threads=1):
+    """
+    B-scan access for sampling: ((Y, X, Z) shape, bscan(y) callable, dtype, dcm).
+    
+    JPEG 2000 files are decoded frame by frame (only the sampled B-scans
+    are decompressed); other files are read whole and indexed. Returns
+    Nones for files that are not 3D volumes.
+    """
+    try:
+        volume = DicomFrameVolume(file_path)
+    except Exception:
+        image, dcm = read_dicom_cached(file_path, cache, threads)
+        if image is None or image.ndim != 3:
+            return None, None, None, None
+        return image.shape, image.__getitem__, image.dtype, dcm
+    if volume.shape is None or len(volume.shape) != 3:
+        return None, None, None, None
+    return volume.shape, volume.bscan, volume.dtype, volume.dcm
+
+def sampling_rounds(n_frames, stride=16):
+    """
+    B-scan indices to sample, as successive rounds of progressive refinement.
+    
+    The first round is every `stride`-th B-scan; each following round fills
+    in the midpoints (stride/2, stride/4, ... 1), so every round doubles the
+    sample and the last one completes the volume.
+    """
+    taken = np.zeros(n_frames, dtype=bool)
+    while True:
+        rows = [y for y in range(0, n_frames, stride) if not taken[y]]
+        taken[rows] = True
+        if rows:
+            yield rows
+        if stride == 1:
+            return
+        stride = max(1, stride // 2)
+
+class SampledScore:
+    """
+    Running estimate of one candidate's selection score from sampled B-scans.
+    
+    Each sampled B-scan contributes one row of the en-face MIP and its
+    intensity histogram (on the raw levels, so the uint8 mapping can follow
+    the min/max of the sample). The score is computed from the ScoringMetric
+    results on the sampled MIP rows and histogram, and its standard error by
+    a delete-one-group jackknife over `n_groups` interleaved groups of
+    B-scans, with the finite-population correction (the error is 0 once
+    every B-scan has been read, and the score equals the full score).
+    Only 8/16-bit data is sampled; other dtypes are scored in full.
+    """
+    n_groups = 8
+    
+    def __init__(self, file_path, score_weights, stride=16, cache=None, threads=1):
+        self.file_path = Path(file_path)
+        self.score_weights = score_weights
+        self.shape, self._bscan, self.dtype, self.dcm = _open_bscans(file_path, cache, threads)
+        self.valid = self.shape is not None
+        if not self.valid:
+            return
+        self.n_frames = self.shape[0]
+        # First round large enough to put a few B-scans in every group
+        stride = min(stride, max(1, self.n_frames // (2 * self.n_groups)))
+        self._rounds = sampling_rounds(self.n_frames, stride)
+        self.exact = self.dtype.kind not in 'iu' or self.dtype.itemsize > 2
+        self._rows = {}
+        self._groups = {}
+        self._hists = None
+        self.lo = self.hi = None
+        self.estimate = self.stderr = None
+    
+    @property
+    def n_sampled(self):
+        if self.exact:
+            return self.n_frames if self.estimate is not None else 0
+        return len(self._rows)
+    
+    @property
+    def complete(self):
+        return self.n_sampled == self.n_frames
+    
+    def sample_next_round(self):
+        """Read the next round of B-scans and update the estimate."""
+        if self.complete:
+            return
+        if self.exact:
+            # Not sampled: one full-volume score, known without error
+            image = np.stack([self._bscan(y) for y in range(self.n_frames)])
+            names = [name for name, _ in self.score_weights]
+            self.estimate = combined_score(score_volume(to_uint8(image), names), self.score_weights)
+            self.stderr = 0.0
+            return
+        
+        unsigned = np.dtype(f'u{self.dtype.itemsize}')
+        if self._hists is None:
+            self._hists = np.zeros((self.n_groups, 2 ** (8 * unsigned.itemsize)), dtype=np.int64)
+        for y in next(self._rounds):
+            bscan = self._bscan(y)
+            group = len(self._rows) % self.n_groups
+            self._rows[y] = bscan.max(axis=1)
+            self._groups[y] = group
+            self._hists[group] += np.bincount(bscan.view(unsigned).reshape(-1),
+                                              minlength=self._hists.shape[1])
+            b_lo, b_hi = bscan.min(), bscan.max()
+            self.lo = b_lo if self.lo is None else min(self.lo, b_lo)
+            self.hi = b_hi if self.hi is None else max(self.hi, b_hi)
+        self._update_estimate()
+    
+    def _score(self, lut, mip_levels, hist):
+        hist8 = np.bincount(lut, weights=hist, minlength=256)
+        mip_z = lut[mip_levels]
+        values = {name: SCORING_METRICS[name]().result(mip_z, hist8)
+                  for name, _ in self.score_weights}
+        return combined_score(values, self.score_weights)
+    
+    def _update_estimate(self):
+        lut, unsigned = _uint8_levels(self.dtype, self.lo, self.hi)
+        ys = sorted(self._rows)
+        mip_levels = np.stack([self._rows[y] for y in ys]).view(unsigned)
+        groups = np.array([self._groups[y] for y in ys])
+        total = self._hists.sum(axis=0)
+        
+        self.estimate = self._score(lut, mip_levels, total)
+        if self.complete:
+            self.stderr = 0.0
+            return
+        
+        # Jackknife over groups of B-scans
+        jackknife = [self._score(lut, mip_levels[groups != g], total - self._hists[g])
+                     for g in range(self.n_groups)]
+        g = self.n_groups
+        variance = (g - 1) / g * np.sum((np.array(jackknife) - np.mean(jackknife)) ** 2)
+        self.stderr = float(np.sqrt(variance * (1 - len(ys) / self.n_frames)))
+    
+    def interval(self, z):
+        return self.estimate - z * self.stderr, self.estimate + z * self.stderr
+
+def select_best_volume_sampled(candidates, score_weights=None, confidence=0.99, stride=16,
+                               cache=None, threads=1, npy_path=None, target_shape=None):
+    """
+    Select the best volume from sampled B-scans, stopping as soon as possible.
+    
+    candidates are the files main has kept: the majority-shape group
+    (target_shape) after the header pre-scan, or every file with
+    --no-prescan, in which case the majority 3D shape among the readable
+    candidates is chosen here. They are sampled in rounds (see sampling_rounds).
+    After each round, every candidate's score gets a `confidence` interval
+    (see SampledScore); candidates that can no longer beat the leader's
+    lower bound are dropped, and sampling stops once the leader's interval
+    is separated from all others. Sampling to completion gives the same
+    selection as select_best_volume. Only the winner is fully decoded
+    (into npy_path, if given; see decode_selected_volume).
+    
+    Returns (OCTAVolume or None, per-file estimates {file path: score}).
+    """
+    score_weights = score_weights or [('contrast', 1.0)]
+    if not candidates:
+        return None, {}
+    
+    alive = []
+    for file_path in candidates:
+        candidate = SampledScore(file_path, score_weights, stride, cache, threads)
+        if candidate.valid:
+            alive.append(candidate)
+    if not alive:
+        return None, {}
+    if target_shape is None:
+        target_shape = _majority_shape([c.shape for c in alive])
+    alive = [c for c in alive if c.shape == target_shape]
+    
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    print(f"\nFound {len(alive)} files with shape {target_shape}")
+    print(f"\nAnalyzing files (sampled B-scans, {confidence:.1%} confidence):")
+    estimates = {}
+    
+    round_number = 0
+    while True:
+        round_number += 1
+        for candidate in alive:
+            candidate.sample_next_round()
+            estimates[candidate.file_path] = candidate.estimate
+        
+        leader = max(alive, key=lambda c: c.estimate)  # first seen wins ties
+        leader_lo = leader.interval(z)[0]
+        print(f"  Round {round_number}: " + ", ".join(
+            f"{c.file_path.name} {c.estimate:.2f}±{z * c.stderr:.2f} ({c.n_sampled}/{c.n_frames})"
+            for c in alive))
+        
+        others = [c for c in alive if c is not leader]
+        if all(c.complete for c in alive) or all(c.interval(z)[1] < leader_lo for c in others):
+            break
+        alive = [c for c in alive if c is leader or c.interval(z)[1] >= leader_lo]
+    
+    print(f"\nSelected: {leader.file_path.name} (highest score, "
+          f"{leader.n_sampled}/{leader.n_frames} B-scans sampled)")
+    print("Decoding full volume...")
+    return decode_selected_volume(leader.file_path, cache, threads, npy_path), estimates
+
+def iter_zyx_pages(volume, z_block=16, y_block=64):
+    """
+    Yield the (Y, X) depth pages of a (Y, X, Z) volume in Z order.
+    
+    Instead of materializing np.transpose(volume, (2, 0, 1)), pages are
+    gathered `z_block` at a time into one small reusable buffer, copying
+    `y_block` B-scans per step so the strided reads stay in cache. The
+    yielded page is a view of that buffer: consume it (e.g. write it)
+    before advancing the generator.
+    """
+    ny, nx, nz = volume.shape
+    buffer = np.empty((min(z_block, nz), ny, nx), dtype=volume.dtype)
+    for z0 in range(0, nz, z_block):
+        z1 = min(z0 + z_block, nz)
+        for y0 in range(0, ny, y_block):
+            y1 = min(y0 + y_block, ny)
+            buffer[:z1 - z0, y0:y1] = volume[y0:y1, :, z0:z1].transpose(2, 0, 1)
+        for k in range(z1 - z0):
+            yield buffer[k]
+
+def write_imagej_tiff(tiff_path, volume, voxel_x, voxel_y, voxel_z):
+    """
+    Write a (Y, X, Z) volume as a (Z, Y, X) ImageJ hyperstack for Imaris/Fiji.
+    
+    Pages are streamed from iter_zyx_pages, so no transposed copy of the
+    volume is made. Resolution (pixels per mm) and Z spacing are embedded
+    as in the ImageJ metadata Imaris reads.
+    """
+    import tifffile
+    
+    ny, nx, nz = volume.shape
+    
+    # Resolution in pixels per mm
+    resolution_x = 1000.0 / voxel_x  # pixels per mm
+    resolution_y = 1000.0 / voxel_y
+    spacing_z = voxel_z / 1000  # mm
+    
+    tifffile.imwrite(
+        tiff_path,
+        iter_zyx_pages(volume),
+        shape=(nz, ny, nx),
+        dtype=volume.dtype,
+        imagej=True,
+        resolution=(resolution_y, resolution_x),
+        metadata={'spacing': spacing_z, 'unit': 'um', 'axes': 'ZYX'}
+    )
+
+def iter_zyx_tiles(volume, tile=256):
+    """
+    Yield (tile, tile) tiles of the (Y, X) depth pages in TIFF order
+    (page by page, tile rows top to bottom, left to right). Edge tiles are
+    smaller; each tile is a copy, so the consumer may buffer them.
+    """
+    ny, nx, _ = volume.shape
+    for page in iter_zyx_pages(volume):
+        for y0 in range(0, ny, tile):
+            for x0 in range(0, nx, tile):
+                yield page[y0:y0 + tile, x0:x0 + tile].copy()
+
+def write_tiled_bigtiff(tiff_path, volume, voxel_x, voxel_y, voxel_z, compression='zlib',
+                        tile=256, threads=1):
+    """
+    Write a (Y, X, Z) volume as a tiled, compressed (Z, Y, X) BigTIFF.
+    
+    Tiles are streamed from iter_zyx_tiles and compressed by tifffile on
+    `threads` cores. ImageJ hyperstacks cannot be tiled or BigTIFF, so the
+    voxel size is embedded as OME-XML physical sizes (read by Imaris and
+    by Fiji through Bio-Formats) plus the X/Y resolution tags in µm.
+    zlib is built in; LZW and zstd need imagecodecs.
+    """
+    import tifffile
+    
+    ny, nx, nz = volume.shape
+    tifffile.imwrite(
+        tiff_path,
+        iter_zyx_tiles(volume, tile),
+        shape=(nz, ny, nx),
+        dtype=volume.dtype,
+        bigtiff=True,
+        ome=True,
+        tile=(tile, tile),
+        compression=compression,
+        maxworkers=threads,
+        resolution=(1.0 / voxel_y, 1.0 / voxel_x),  # pixels per µm
+        resolutionunit='MICROMETER',
+        metadata={
+            'axes': 'ZYX',
+            'PhysicalSizeX': voxel_x, 'PhysicalSizeXUnit': 'µm',
+            'PhysicalSizeY': voxel_y, 'PhysicalSizeYUnit': 'µm',
+            'PhysicalSizeZ': voxel_z, 'PhysicalSizeZUnit': 'µm',
+        }
+    )
+
+def nifti_header_bytes(volume, voxel_size, description):
+    """
+    Single-file NIfTI-1 header (348 bytes + empty extension flag) for a
+    (Y, X, Z) uint8 volume stored as (X, Y, Z) with voxel sizes in µm.
+    """
+    import nibabel as nib
+    
+    voxel_x, voxel_y, voxel_z = voxel_size
+    ny, nx, nz = volume.shape
+    
+    # Create affine matrix with voxel sizes (in mm)
+    # NIfTI expects voxel sizes in mm
+    affine = np.array([
+        [voxel_x / 1000, 0, 0, 0],
+        [0, voxel_y / 1000, 0, 0],
+        [0, 0, voxel_z / 1000, 0],
+        [0, 0, 0, 1]
+    ])
+    
+    header = nib.Nifti1Header()
+    header.set_data_dtype(volume.dtype)
+    header.set_data_shape((nx, ny, nz))
+    header.set_qform(affine, code='unknown')
+    header.set_sform(affine, code='aligned')
+    header['descrip'] = description.encode('utf-8')
+    header['xyzt_units'] = 2  # mm for spatial units
+    header.set_data_offset(352)
+    return header.binaryblock + b'\x00' * 4
+
+def iter_nifti_chunks(volume, voxel_size, description, chunk_bytes=16 * 1024 * 1024):
+    """
+    Yield a .nii file as byte chunks of about `chunk_bytes`.
+    
+    NIfTI data is (X, Y, Z) in Fortran order, i.e. X fastest and Z slowest:
+    exactly the (Y, X) depth pages of the (Y, X, Z) volume in Z order, so the
+    data comes straight from iter_zyx_pages without a transposed copy.
+    """
+    yield nifti_header_bytes(volume, voxel_size, description)
+    chunk = []
+    size = 0
+    for page in iter_zyx_pages(volume):
+        chunk.append(page.tobytes())
+        size += page.nbytes
+        if size >= chunk_bytes:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+def write_nifti(nifti_path, volume, voxel_size, description, compression='gzip', level=1, threads=1):
+    """
+    Write a (Y, X, Z) volume as NIfTI-1.
+    
+    - 'none': uncompressed .nii.
+    - 'gzip': single-stream gzip at `level` (nibabel's default is 1).
+    - 'parallel': the file is cut into 16 MB chunks and each chunk is
+      compressed on a thread pool as its own gzip member (zlib releases the
+      GIL). Concatenated members are a valid gzip file, so ITK-SNAP, 3D
+      Slicer and nibabel read it like any .nii.gz.
+    """
+    chunks = iter_nifti_chunks(volume, voxel_size, description)
+    
+    if compression == 'none':
+        with open(nifti_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+    elif compression == 'gzip':
+        with gzip.open(nifti_path, 'wb', compresslevel=level) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    elif compression == 'parallel':
+        with open(nifti_path, 'wb') as f, ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(gzip.compress, chunk, level, mtime=0))
+                # Keep a bounded number of chunks in memory, written in order
+                while len(pending) > 2 * threads:
+                    f.write(pending.popleft().result())
+            while pending:
+                f.write(pending.popleft().result())
+    else:
+        raise ValueError(f"Unknown NIfTI compression '{compression}'")
+
+# NIfTI settings compared by --nifti-benchmark: (compression, level)
+NIFTI_BENCHMARK_SETTINGS = [('none', 0), ('gzip', 1), ('gzip', 6), ('gzip', 9),
+                            ('parallel', 1), ('parallel', 6), ('parallel', 9)]
+
+def benchmark_nifti(volume, voxel_size, threads=1, settings=NIFTI_BENCHMARK_SETTINGS):
+    """Write the volume with each NIfTI setting to a temp folder and print size vs time."""
+    import tempfile
+    
+    raw_mb = volume.nbytes / 1024 / 1024
+    print(f"NIfTI benchmark: {volume.shape} uint8 ({raw_mb:.1f} MB), {threads} threads for 'parallel'\n")
+    print(f"  {'Setting':<14} {'Size (MB)':>10} {'Ratio':>7} {'Time (s)':>9} {'MB/s':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression, level in settings:
+            path = Path(tmp) / ("bench.nii" if compression == 'none' else "bench.nii.gz")
+            start = time.perf_counter()
+            write_nifti(path, volume, voxel_size, "benchmark", compression, level, threads)
+            elapsed = time.perf_counter() - start
+            size_mb = _size_mb(path)
+            name = compression if compression == 'none' else f"{compression} -{level}"
+            print(f"  {name:<14} {size_mb:>10.2f} {raw_mb / size_mb:>6.2f}x {elapsed:>9.2f} "
+                  f"{raw_mb / elapsed if elapsed else float('inf'):>8.1f}")
+            path.unlink()
+
+def downsample_2x(volume, block=64):
+    """
+    Halve a (Y, X, Z) uint8 volume along every axis by 2x2x2 averaging.
+    
+    Odd sizes are padded by repeating the last plane (output size is
+    ceil(n / 2)). Works on `block` B-scans at a time, so the float32
+    temporary stays small.
+    """
+    ny, nx, nz = volume.shape
+    out = np.empty(((ny + 1) // 2, (nx + 1) // 2, (nz + 1) // 2), dtype=np.uint8)
+    for y0 in range(0, ny, block):
+        b = volume[y0:y0 + block].astype(np.float32)
+        pad = [(0, size % 2) for size in b.shape]
+        if any(after for _, after in pad):
+            b = np.pad(b, pad, mode='edge')
+        by, bx, bz = b.shape
+        b = b.reshape(by // 2, 2, bx // 2, 2, bz // 2, 2).mean(axis=(1, 3, 5))
+        out[y0 // 2:y0 // 2 + by // 2] = np.rint(b)
+    return out
+
+def pyramid_levels(volume, min_voxels=1024 * 1024):
+    """
+    Resolution pyramid of a (Y, X, Z) volume: the volume itself, then
+    downsample_2x levels until a level has at most `min_voxels` voxels.
+    """
+    levels = [volume]
+    while levels[-1].size > min_voxels and max(levels[-1].shape) > 1:
+        levels.append(downsample_2x(levels[-1]))
+    return levels
+
+def _ims_attr(node, name, value):
+    """Imaris stores attributes as arrays of single characters."""
+    node.attrs[name] = np.frombuffer(str(value).encode('utf-8'), dtype='|S1')
+
+def write_ims(ims_path, volume, voxel_size, name='OCTA', recording_date=None,
+              chunks=(32, 128, 128), min_voxels=1024 * 1024, compression_level=2):
+    """
+    Write a (Y, X, Z) uint8 volume as a native Imaris 5.5 file (.ims, HDF5).
+    
+    Layout: DataSet/ResolutionLevel r/TimePoint 0/Channel 0/Data as (Z, Y, X),
+    gzip-compressed and chunked, padded to whole chunks like Imaris' own
+    files, with the true size and a 256-bin Histogram per level. Levels
+    are 2x2x2 averages (pyramid_levels) down to about `min_voxels`, so Imaris
+    does not have to build the pyramid on first open. DataSetInfo holds the
+    physical extents from the voxel size (µm).
+    """
+    import h5py
+    
+    voxel_x, voxel_y, voxel_z = voxel_size
+    ny, nx, nz = volume.shape
+    
+    levels = pyramid_levels(volume, min_voxels)
+    
+    with h5py.File(ims_path, 'w') as f:
+        for key, value in [('DataSetDirectoryName', 'DataSet'), ('DataSetInfoDirectoryName', 'DataSetInfo'),
+                           ('ImarisDataSet', 'ImarisDataSet'), ('ImarisVersion', '5.5.0'),
+                           ('ThumbnailDirectoryName', 'Thumbnail')]:
+            _ims_attr(f, key, value)
+        f.attrs['NumberOfDataSets'] = np.array([1], dtype=np.uint32)
+        
+        for r, level in enumerate(levels):
+            ly, lx, lz = level.shape
+            chunk = tuple(min(c, s) for c, s in zip(chunks, (lz, ly, lx)))
+            padded = tuple(-(-s // c) * c for s, c in zip((lz, ly, lx), chunk))
+            channel = f.create_group(f'DataSet/ResolutionLevel {r}/TimePoint 0/Channel 0')
+            data = channel.create_dataset('Data', shape=padded, dtype=np.uint8, chunks=chunk,
+                                          compression='gzip', compression_opts=compression_level)
+            # One chunk-deep slab of Z pages at a time, so every chunk is compressed once
+            for z0 in range(0, lz, chunk[0]):
+                z1 = min(z0 + chunk[0], lz)
+                data[z0:z1, :ly, :lx] = level[:, :, z0:z1].transpose(2, 0, 1)
+            
+            hist = np.zeros(256, dtype=np.uint64)
+            for start in range(0, ly, 16):
+                hist += np.bincount(level[start:start + 16].reshape(-1), minlength=256).astype(np.uint64)
+            channel.create_dataset('Histogram', data=hist)
+            for key, value in [('ImageSizeX', lx), ('ImageSizeY', ly), ('ImageSizeZ', lz),
+                               ('ImageBlockSizeX', chunk[2]), ('ImageBlockSizeY', chunk[1]),
+                               ('ImageBlockSizeZ', chunk[0]),
+                               ('HistogramMin', '0.000'), ('HistogramMax', '255.000')]:
+                _ims_attr(channel, key, value)
+        
+        info = f.create_group('DataSetInfo')
+        image = info.create_group('Image')
+        for key, value in [('X', nx), ('Y', ny), ('Z', nz), ('Unit', 'um'), ('Noc', 1),
+                           ('Name', name), ('Description', name),
+                           ('RecordingDate', recording_date or '2000-01-01 00:00:00.000'),
+                           ('ExtMin0', 0), ('ExtMin1', 0), ('ExtMin2', 0),
+                           ('ExtMax0', f'{nx * voxel_x:.3f}'), ('ExtMax1', f'{ny * voxel_y:.3f}'),
+                           ('ExtMax2', f'{nz * voxel_z:.3f}')]:
+            _ims_attr(image, key, value)
+        channel_info = info.create_group('Channel 0')
+        for key, value in [('Name', 'OCTA'), ('Color', '1.000 1.000 1.000'), ('ColorMode', 'BaseColor'),
+                           ('ColorOpacity', '1.000'), ('ColorRange', '0.000 255.000')]:
+            _ims_attr(channel_info, key, value)
+        time_info = info.create_group('TimeInfo')
+        for key, value in [('DatasetTimePoints', 1), ('FileTimePoints', 1),
+                           ('TimePoint1', recording_date or '2000-01-01 00:00:00.000')]:
+            _ims_attr(time_info, key, value)
+        imaris = info.create_group('Imaris')
+        _ims_attr(imaris, 'Version', '7.0')
+        _ims_attr(imaris, 'ThumbnailMode', 'thumbnailMIP')
+        
+        # 256x256 RGBA thumbnail of the en-face MIP (from the smallest level)
+        mip = np.max(levels[-1], axis=2)
+        rows = np.arange(256) * mip.shape[0] // 256
+        cols = np.arange(256) * mip.shape[1] // 256
+        thumb = mip[rows[:, None], cols[None, :]]
+        rgba = np.stack([thumb, thumb, thumb, np.full_like(thumb, 255)], axis=-1)
+        f.create_dataset('Thumbnail/Data', data=rgba.reshape(256, 256 * 4))
+
+def _ims_date(study_date):
+    """DICOM StudyDate (YYYYMMDD) as an Imaris date string, or None."""
+    if study_date and len(study_date) == 8 and study_date.isdigit():
+        return f"{study_date[:4]}-{study_date[4:6]}-{study_date[6:]} 00:00:00.000"
+    return None
+
+def write_ome_zarr(zarr_path, volume, voxel_size, name='OCTA', chunks=(64, 128, 128),
+                   min_voxels=1024 * 1024, compression_level=1, threads=1):
+    """
+    Write a (Y, X, Z) uint8 volume as an OME-Zarr (NGFF 0.4, Zarr v2) image.
+    
+    Arrays are stored as (z, y, x) with the given chunk shape, one
+    zlib-compressed file per chunk, so readers such as zarr/dask can load
+    only the slab or sub-block they need. Scale levels 0, 1, ... are the
+    same 2x pyramid as the .ims (pyramid_levels); the multiscales metadata
+    carries the axis names and per-level voxel size in micrometers.
+    Chunks are compressed and written on `threads` threads (zlib releases
+    the GIL). The format is written directly, so zarr is not required.
+    """
+    voxel_x, voxel_y, voxel_z = voxel_size
+    zarr_path = Path(zarr_path)
+    if zarr_path.exists():
+        shutil.rmtree(zarr_path)
+    zarr_path.mkdir(parents=True)
+    
+    def write_json(path, content):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=2)
+    
+    def write_chunk(path, block):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(block.tobytes(), compression_level))
+    
+    datasets = []
+    levels = pyramid_levels(volume, min_voxels)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for r, level in enumerate(levels):
+            ly, lx, lz = level.shape
+            chunk = tuple(min(c, s) for c, s in zip(chunks, (lz, ly, lx)))
+            level_path = zarr_path / str(r)
+            level_path.mkdir()
+            write_json(level_path / ".zarray", {
+                'zarr_format': 2,
+                'shape': [lz, ly, lx],
+                'chunks': list(chunk),
+                'dtype': '|u1',
+                'compressor': {'id': 'zlib', 'level': compression_level},
+                'fill_value': 0,
+                'order': 'C',
+                'filters': None,
+                'dimension_separator': '/',
+            })
+            
+            # One chunk-deep slab of Z pages at a time, padded to whole chunks
+            cz, cy, cx = chunk
+            slab = np.zeros((cz, -(-ly // cy) * cy, -(-lx // cx) * cx), dtype=np.uint8)
+            for iz, z0 in enumerate(range(0, lz, cz)):
+                z1 = min(z0 + cz, lz)
+                slab[:] = 0
+                slab[:z1 - z0, :ly, :lx] = level[:, :, z0:z1].transpose(2, 0, 1)
+                futures = [executor.submit(write_chunk, level_path / str(iz) / str(iy) / str(ix),
+                                           slab[:, y0:y0 + cy, x0:x0 + cx].copy())
+                           for iy, y0 in enumerate(range(0, ly, cy))
+                           for ix, x0 in enumerate(range(0, lx, cx))]
+                for future in futures:
+                    future.result()
+            
+            scale = 2 ** r
+            datasets.append({
+                'path': str(r),
+                'coordinateTransformations': [
+                    {'type': 'scale', 'scale': [voxel_z * scale, voxel_y * scale, voxel_x * scale]}
+                ],
+            })
+    
+    write_json(zarr_path / ".zgroup", {'zarr_format': 2})
+    write_json(zarr_path / ".zattrs", {
+        'multiscales': [{
+            'version': '0.4',
+            'name': name,
+            'axes': [{'name': axis, 'type': 'space', 'unit': 'micrometer'} for axis in 'zyx'],
+            'datasets': datasets,
+            'type': 'mean',
+            'metadata': {'method': 'downsample_2x', 'description': '2x2x2 block average'},
+        }]
+    })
+
+def colormap_lut(name):
+    """256-entry RGB lookup table (uint8) for the 'hot' and 'gray' colormaps."""
+    x = np.linspace(0.0, 1.0, 256)
+    if name == 'hot':
+        # matplotlib's 'hot': black -> red -> yellow -> white
+        rgb = np.stack([np.clip(8 / 3 * x, 0, 1),
+                        np.clip(8 / 3 * x - 1, 0, 1),
+                        np.clip(4 * x - 3, 0, 1)], axis=1)
+    elif name == 'gray':
+        rgb = np.stack([x, x, x], axis=1)
+    else:
+        raise ValueError(f"Unknown colormap '{name}'")
+    return np.rint(rgb * 255).astype(np.uint8)
+
+def render_panel(image, cmap, height, width):
+    """
+    Color a uint8 image and resize it (nearest neighbour) to height x width.
+    
+    Like imshow, the colors span the image's own min..max. Scaling and
+    colormap are folded into one 256-entry RGB table, so the image is
+    mapped with a single lookup.
+    """
+    lo, hi = int(image.min()), int(image.max())
+    levels = np.arange(256, dtype=np.float64)
+    index = np.clip(np.floor((levels - lo) / max(hi - lo, 1) * 256), 0, 255).astype(np.intp)
+    lut = colormap_lut(cmap)[index]
+    rows = np.arange(height) * image.shape[0] // height
+    cols = np.arange(width) * image.shape[1] // width
+    return lut[image[rows[:, None], cols[None, :]]]
+
+def write_png(png_path, rgb, compression_level=6):
+    """Minimal PNG encoder for an (H, W, 3) uint8 image (8-bit RGB, no filtering)."""
+    height, width, _ = rgb.shape
+    scanlines = np.zeros((height, 1 + width * 3), dtype=np.uint8)  # filter type 0 per row
+    scanlines[:, 1:] = rgb.reshape(height, -1)
+    
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data
+                + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    
+    with open(png_path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), compression_level)))
+        f.write(chunk(b'IEND', b''))
+
+def render_preview(mip_z, mip_y, mip_x, central_slice, panel=512, margin=12):
+    """
+    Tile the four preview panels into one RGB image (2 x 2, white margins):
+    en-face MIP and central depth slice keep their pixel aspect, the two
+    side-view MIPs fill their panel, as in the matplotlib figure.
+    """
+    def fit(image):
+        h, w = image.shape
+        scale = panel / max(h, w)
+        return max(1, round(h * scale)), max(1, round(w * scale))
+    
+    panels = [
+        render_panel(mip_z, 'hot', *fit(mip_z)),
+        render_panel(mip_y, 'hot', panel, panel),
+        render_panel(mip_x, 'hot', panel, panel),
+        render_panel(central_slice, 'gray', *fit(central_slice)),
+    ]
+    size = 2 * panel + 3 * margin
+    canvas = np.full((size, size, 3), 255, dtype=np.uint8)
+    for i, image in enumerate(panels):
+        top = margin + (i // 2) * (panel + margin) + (panel - image.shape[0]) // 2
+        left = margin + (i % 2) * (panel + margin) + (panel - image.shape[1]) // 2
+        canvas[top:top + image.shape[0], left:left + image.shape[1]] = image
+    return canvas
+
+class ExportJob:
+    """
+    What every output writer needs: the shared read-only uint8 (Y, X, Z)
+    volume, the output location and naming, voxel size (µm), metadata and
+    writer options. Writers record the files they wrote in `paths`.
+    `pool_threads` is each compressing writer's share of the cores (set by
+    write_outputs).
+    """
+    
+    def __init__(self, volume_uint8, output_folder, base_name, folder_name, voxel_size, meta_data,
+                 options=None):
+        self.volume = volume_uint8
+        self.output_folder = output_folder
+        self.base_name = base_name
+        self.folder_name = folder_name
+        self.voxel_x, self.voxel_y, self.voxel_z = voxel_size
+        self.meta_data = meta_data
+        self.options = options or {}
+        self.paths = {}
+        self.projections = {}  # OCTAVolume.projections(), filled before the writers start
+        self.pool_threads = self.options.get('threads', 1)
+    
+    def path(self, suffix):
+        return self.output_folder / f"{self.base_name}{suffix}"
+
+def _size_mb(path):
+    return path.stat().st_size / 1024 / 1024
+
+def write_npy_output(job):
+    """NumPy array (.npy); usually already written in place by OCTAVolume.write_npy."""
+    npy_path = job.path(".npy")
+    if isinstance(job.volume, np.memmap) and Path(job.volume.filename) == npy_path.resolve():
+        job.volume.flush()
+    else:
+        np.save(npy_path, job.volume)
+    job.paths['npy'] = npy_path
+    return [f"{npy_path.name} ({_size_mb(npy_path):.2f} MB)"]
+
+def write_metadata_output(job):
+    """Scan parameters and voxel size (JSON)."""
+    json_path = job.path("_metadata.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(job.meta_data, f, indent=2)
+    job.paths['json'] = json_path
+    return [json_path.name]
+
+def write_tiff_output(job):
+    """TIFF stack (Z, Y, X) for Imaris: ImageJ (default) or tiled BigTIFF."""
+    tiff_path = job.path(".tif")
+    ny, nx, nz = job.volume.shape
+    if job.options.get('tiff_format', 'imagej') == 'bigtiff':
+        compression = job.options.get('tiff_compression', 'zlib')
+        tile = job.options.get('tiff_tile', 256)
+        write_tiled_bigtiff(tiff_path, job.volume, job.voxel_x, job.voxel_y, job.voxel_z,
+                            compression, tile, job.pool_threads)
+        kind = f"tiled BigTIFF, {compression}, {tile}x{tile} tiles"
+    else:
+        write_imagej_tiff(tiff_path, job.volume, job.voxel_x, job.voxel_y, job.voxel_z)
+        kind = "ImageJ"
+    job.paths['tiff'] = tiff_path
+    return [f"{tiff_path.name} ({_size_mb(tiff_path):.2f} MB, {kind}), (Z, Y, X) = {(nz, ny, nx)}",
+            "✓ Ready for Imaris!"]
+
+def write_nifti_output(job):
+    """NIfTI for medical imaging software (compression per --nifti-compression)."""
+    compression = job.options.get('nifti_compression', 'gzip')
+    level = job.options.get('nifti_level', 1)
+    nifti_path = job.path(".nii" if compression == 'none' else ".nii.gz")
+    voxel_x, voxel_y, voxel_z = job.voxel_x, job.voxel_y, job.voxel_z
+    ny, nx, nz = job.volume.shape
+    
+    write_nifti(nifti_path, job.volume, (voxel_x, voxel_y, voxel_z), f'Zeiss OCTA {job.folder_name}',
+                compression, level, job.pool_threads)
+    job.paths['nifti'] = nifti_path
+    
+    method = "uncompressed" if compression == 'none' else f"{compression}, level {level}"
+    return [f"{nifti_path.name} ({_size_mb(nifti_path):.2f} MB, {method})",
+            f"Shape: {(nx, ny, nz)} (X, Y, Z)",
+            f"Voxel size: {voxel_x/1000:.4f} x {voxel_y/1000:.4f} x {voxel_z/1000:.4f} mm",
+            "✓ Ready for medical imaging software!"]
+
+def write_ims_output(job):
+    """Native Imaris file (.ims) with resolution pyramid and histograms."""
+    ims_path = job.path(".ims")
+    write_ims(ims_path, job.volume, (job.voxel_x, job.voxel_y, job.voxel_z),
+              name=f'Zeiss OCTA {job.folder_name}',
+              recording_date=_ims_date(job.meta_data.get('study_date')))
+    job.paths['ims'] = ims_path
+    return [f"{ims_path.name} ({_size_mb(ims_path):.2f} MB)",
+            "✓ Opens in Imaris without conversion"]
+
+def write_zarr_output(job):
+    """Chunked OME-Zarr with a multiscale pyramid."""
+    zarr_path = job.path(".ome.zarr")
+    chunks = job.options.get('zarr_chunks', (64, 128, 128))
+    write_ome_zarr(zarr_path, job.volume, (job.voxel_x, job.voxel_y, job.voxel_z),
+                   name=f'Zeiss OCTA {job.folder_name}', chunks=chunks,
+                   threads=job.pool_threads)
+    job.paths['zarr'] = zarr_path
+    size_mb = sum(p.stat().st_size for p in zarr_path.rglob('*') if p.is_file()) / 1024 / 1024
+    n_levels = sum(1 for p in zarr_path.iterdir() if p.is_dir())
+    return [f"{zarr_path.name} ({size_mb:.2f} MB, {n_levels} scale levels, chunks (z, y, x) = {tuple(chunks)})"]
+
+def write_preview_output(job):
+    """
+    MIP preview (PNG): en-face, two side views and the central depth slice.
+    
+    The default renderer colors the projections through 256-entry LUTs and
+    writes the PNG itself (render_preview, write_png), reusing the MIPs
+    cached on the volume. --preview-style matplotlib draws the titled
+    figure instead (matplotlib is only needed for that).
+    """
+    if job.options.get('preview_style', 'fast') == 'matplotlib':
+        return _write_preview_matplotlib(job)
+    
+    volume_uint8 = job.volume
+    mip_z, mip_y, mip_x = _preview_mips(job)
+    central_z = volume_uint8.shape[2] // 2
+    
+    preview_path = job.path("_Preview.png")
+    write_png(preview_path, render_preview(mip_z, mip_y, mip_x, volume_uint8[:, :, central_z]))
+    job.paths['preview'] = preview_path
+    return [preview_path.name]
+
+def _preview_mips(job):
+    """The three axis MIPs, from job.projections or one compute_projections pass."""
+    projections = job.projections
+    if not all(kind in projections for kind in ('max_z', 'max_y', 'max_x')):
+        projections = compute_projections(job.volume, ('max_z', 'max_y', 'max_x'))
+    return projections['max_z'], projections['max_y'], projections['max_x']
+
+def _write_preview_matplotlib(job):
+    """MIP preview figure (PNG) drawn with matplotlib, with panel titles."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    
+    volume_uint8 = job.volume
+    folder_name = job.folder_name
+    
+    # Maximum intensity projections
+    mip_z, mip_y, mip_x = _preview_mips(job)
+    
+    fig, axes = plt.subplots(2, 2, figsize=(12, 12))
+    
+    axes[0, 0].imshow(mip_z, cmap='hot')
+    axes[0, 0].set_title(f'En Face (MIP Z)\n{folder_name}', fontsize=12, weight='bold')
+    axes[0, 0].axis('off')
+    
+    axes[0, 1].imshow(mip_y, cmap='hot', aspect='auto')
+    axes[0, 1].set_title('Side view (MIP Y)', fontsize=10)
+    axes[0, 1].axis('off')
+    
+    axes[1, 0].imshow(mip_x, cmap='hot', aspect='auto')
+    axes[1, 0].set_title('Side view (MIP X)', fontsize=10)
+    axes[1, 0].axis('off')
+    
+    # Central depth slice
+    central_z = volume_uint8.shape[2] // 2
+    axes[1, 1].imshow(volume_uint8[:, :, central_z], cmap='gray')
+    axes[1, 1].set_title(f'Central depth slice (Z={central_z})', fontsize=10)
+    axes[1, 1].axis('off')
+    
+    plt.tight_layout()
+    preview_path = job.path("_Preview.png")
+    plt.savefig(preview_path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    job.paths['preview'] = preview_path
+    return [preview_path.name]
+
+# Output writers by --outputs name: (label, writer, install hint)
+OUTPUT_WRITERS = {
+    'npy': ("NumPy", write_npy_output, None),
+    'json': ("Metadata", write_metadata_output, None),
+    'tiff': ("TIFF", write_tiff_output, "pip install tifffile"),
+    'nifti': ("NIfTI", write_nifti_output, "pip install nibabel"),
+    'ims': ("Imaris", write_ims_output, "pip install h5py"),
+    'preview': ("Preview", write_preview_output, "pip install matplotlib (--preview-style matplotlib)"),
+    'zarr': ("OME-Zarr", write_zarr_output, None),
+}
+
+# Written when --outputs is not given (OME-Zarr is opt-in)
+DEFAULT_OUTPUTS = ['npy', 'json', 'tiff', 'nifti', 'ims', 'preview']
+
+# Incremental rebuilds: Results/<folder>/manifest.json records what a conversion used and produced
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Options that change which file is selected (a change means a full re-run)
+MANIFEST_SELECTION_OPTIONS = ['prescan', 'dedupe', 'preview_decode', 'sample', 'sample_confidence',
+                              'sample_stride', 'score']
+
+# Writer options that change an output file (a change means that output is rebuilt)
+MANIFEST_OUTPUT_OPTIONS = {
+    'tiff': ['tiff_format', 'tiff_compression', 'tiff_tile'],
+    'nifti': ['nifti_compression', 'nifti_level'],
+    'zarr': ['zarr_chunks'],
+    'preview': ['preview_style'],
+}
+
+def _file_sha1(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _as_json(value):
+    """Normalize options the way they read back from JSON (tuples become lists)."""
+    return json.loads(json.dumps(value))
+
+def converter_fingerprint():
+    """Version and content hash of this script: any code change invalidates old outputs."""
+    return {'version': __version__, 'sha1': _file_sha1(__file__)}
+
+def input_fingerprints(dcm_files, data_folder, previous=None):
+    """
+    {relative path: {'size', 'mtime_ns', 'sha1', 'pixel_sha1'}} for the input files.
+    
+    Files whose size and mtime match the previous manifest keep their
+    recorded hashes; only new or touched files are read, once for both the
+    file hash and the PixelData digest used by dedupe_volumes.
+    """
+    known = (previous or {}).get('inputs', {})
+    inputs = {}
+    for file_path in dcm_files:
+        key = Path(file_path).relative_to(data_folder).as_posix()
+        stat = Path(file_path).stat()
+        entry = known.get(key)
+        if (entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+                and 'pixel_sha1' in entry):
+            inputs[key] = entry
+        else:
+            sha1, pixel_sha1 = file_digests(file_path)
+            inputs[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                           'sha1': sha1, 'pixel_sha1': pixel_sha1}
+    return inputs
+
+def _dir_stats(path):
+    """(total size, newest mtime_ns) of the files under a directory."""
+    stats = [p.stat() for p in path.rglob('*') if p.is_file()]
+    return sum(st.st_size for st in stats), max((st.st_mtime_ns for st in stats), default=0)
+
+def _dir_sha1(path, chunk_size=1024 * 1024):
+    """Content hash of a directory: every file's relative name and bytes, in sorted order."""
+    digest = hashlib.sha1()
+    for p in sorted(p for p in path.rglob('*') if p.is_file()):
+        digest.update(f"{p.relative_to(path).as_posix()}\n".encode())
+        with open(p, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def output_fingerprint(path):
+    """Size, mtime and content hash of an output file or directory (OME-Zarr chunks)."""
+    path = Path(path)
+    if path.is_dir():
+        size, mtime_ns = _dir_stats(path)
+        return {'file': path.name, 'size': size, 'mtime_ns': mtime_ns, 'sha1': _dir_sha1(path)}
+    stat = path.stat()
+    return {'file': path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': _file_sha1(path)}
+
+def output_is_fresh(entry, output_folder):
+    """True if a recorded output still exists unchanged (same size/mtime, or same hash)."""
+    path = Path(output_folder) / entry['file']
+    if not path.exists():
+        return False
+    if path.is_dir():
+        size, mtime_ns = _dir_stats(path)
+        if size != entry['size']:
+            return False
+        return mtime_ns == entry['mtime_ns'] or _dir_sha1(path) == entry['sha1']
+    stat = path.stat()
+    if stat.st_size != entry['size']:
+        return False
+    return stat.st_mtime_ns == entry['mtime_ns'] or _file_sha1(path) == entry['sha1']
+
+def load_manifest(manifest_path):
+    """The previous conversion's manifest, or None if missing or unreadable."""
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('manifest_version') == MANIFEST_VERSION else None
+
+def write_manifest(manifest_path, manifest):
+    tmp_path = Path(manifest_path).with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def manifest_matches(manifest, inputs, selection_options):
+    """True if inputs, converter and selection options are those of the manifest."""
+    same_inputs = ({k: (v['size'], v['sha1']) for k, v in manifest.get('inputs', {}).items()}
+                   == {k: (v['size'], v['sha1']) for k, v in inputs.items()})
+    return (same_inputs
+            and manifest.get('converter') == converter_fingerprint()
+            and manifest.get('selection_options') == _as_json(selection_options))
+
+def output_options(name, writer_options):
+    return _as_json({key: writer_options[key] for key in MANIFEST_OUTPUT_OPTIONS.get(name, [])})
+
+def stale_outputs(manifest, output_folder, outputs, writer_options):
+    """The requested outputs that are missing, modified or written with other options."""
+    recorded = manifest.get('outputs', {})
+    return [name for name in outputs
+            if name not in recorded
+            or recorded[name].get('options') != output_options(name, writer_options)
+            or not output_is_fresh(recorded[name], output_folder)]
+
+def load_previous_volume(manifest, data_folder, npy_file, npy_path=None, cache=None, threads=1):
+    """
+    The volume selected by a previous run, without repeating the selection.
+    
+    If the previous .npy is still fresh (and is not being rebuilt, i.e.
+    npy_path is None), it is memory-mapped; otherwise only the selected
+    file is decoded (into npy_path, if given). Returns an OCTAVolume or None.
+    """
+    file_path = Path(data_folder) / manifest['selected_file']
+    if not file_path.exists():
+        return None
+    
+    entry = manifest.get('outputs', {}).get('npy')
+    if npy_path is None and entry and output_is_fresh(entry, npy_file.parent):
+        dcm = read_dicom_header(file_path)
+        uint8 = np.load(npy_file, mmap_mode='r')
+        print(f"Reusing {npy_file.name} (selected file: {manifest['selected_file']})")
+        return OCTAVolume.from_uint8(uint8, manifest['source_dtype'], dcm, file_path,
+                                     tuple(manifest['source_range']))
+    
+    print(f"Decoding selected file: {manifest['selected_file']}")
+    return decode_selected_volume(file_path, cache, threads, npy_path)
+
+# Writers that compress on their own thread pool, given the writer options
+POOLED_WRITERS = {
+    'tiff': lambda options: options.get('tiff_format', 'imagej') == 'bigtiff',
+    'nifti': lambda options: options.get('nifti_compression', 'gzip') == 'parallel',
+    'zarr': lambda options: True,
+}
+
+def write_outputs(job, outputs, threads=None):
+    """
+    Output scheduler: run the selected writers concurrently on a thread pool.
+    
+    The writers only read the shared uint8 volume (it is made read-only
+    here), and are mostly I/O or compression bound (gzip, zlib and file
+    writes release the GIL), so a slow writer such as the NIfTI gzip no
+    longer holds up the others. Each writer's messages are printed together
+    when it finishes, and a failure only affects that writer.
+    
+    Writers with their own compression pool (POOLED_WRITERS: tiled BigTIFF,
+    parallel-gzip NIfTI, OME-Zarr) split options['threads'] between those
+    that can run at the same time, instead of each starting that many.
+    
+    Returns {output name: 'ok' | 'skipped' | 'failed'}.
+    """
+    job.volume.flags.writeable = False
+    numbers = {name: i for i, name in enumerate(outputs, 1)}
+    status = {}
+    max_workers = threads or len(outputs)
+    
+    pooled = [name for name in outputs if name in POOLED_WRITERS and POOLED_WRITERS[name](job.options)]
+    concurrent = min(len(pooled), max_workers) or 1
+    job.pool_threads = max(1, job.options.get('threads', 1) // concurrent)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(OUTPUT_WRITERS[name][1], job): name for name in outputs}
+        for future in as_completed(futures):
+            name = futures[future]
+            label, _, hint = OUTPUT_WRITERS[name]
+            prefix = f"[{numbers[name]}] {label}:"
+            try:
+                lines = future.result()
+            except ImportError as e:
+                print(f"{prefix} Skipped ({e.name or e} not installed)")
+                if hint:
+                    print(f"    Install with: {hint}")
+                status[name] = 'skipped'
+                continue
+            except Exception as e:
+                print(f"{prefix} ERROR - {e}")
+                status[name] = 'failed'
+                continue
+            print(f"{prefix} {lines[0]}")
+            for line in lines[1:]:
+                print(f"    {line}")
+            status[name] = 'ok'
+    
+    return {name: status[name] for name in outputs}
+
+def parse_args(argv):
+    """Parse command-line options (folder name plus performance settings)."""
+    parser = argparse.ArgumentParser(
+        description="Zeiss Cirrus OCTA DICOM to TIFF Converter"
+    )
+    parser.add_argument('folder_name', help="Data folder name (e.g. HenkE433)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes for DICOM decoding (0 = all cores, default: 1)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Threads for decoding the frames of one file (default: all cores divided by --workers)")
+    parser.add_argument('--no-prescan', dest='prescan', action='store_false',
+                        help="Decompress every file instead of pre-scanning headers for the majority shape")
+    parser.add_argument('--no-dedupe', dest='dedupe', action='store_false',
+                        help="Do not skip files with identical compressed PixelData")
+    parser.add_argument('--preview-decode', type=int, choices=[4, 8], default=None, metavar='N',
+                        help="Score candidates from 1/N of the B-scans (4 or 8) and fully decode only the winner")
+    parser.add_argument('--preview-report', action='store_true',
+                        help="Report how often preview and full-decode rankings agree (folder of exams or single exam)")
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="Do not read or write the decoded-volume cache")
+    parser.add_argument('--cache-dir', type=Path, default=Path(__file__).parent / "Cache",
+                        help="Decoded-volume cache location (default: Cache/ next to this script)")
+    parser.add_argument('--cache-size', type=float, default=10.0, metavar='GB',
+                        help="Decoded-volume cache size cap in GB (default: 10)")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="Delete all cached volumes before converting")
+    parser.add_argument('--repair-report', action='store_true',
+                        help="Repair all headers in the folder and report the fixes, without converting")
+    parser.add_argument('--score', default='contrast', metavar='SPEC',
+                        help="Selection metrics as name[:weight],... (available: "
+                             + ", ".join(SCORING_METRICS) + "; default: contrast). motion is the "
+                             "mean difference between neighbouring rows of the en-face MIP "
+                             "(eye-motion line artefacts, lower is better)")
+    parser.add_argument('--sample', action='store_true',
+                        help="Score from sampled B-scans with confidence-based early exit")
+    parser.add_argument('--sample-confidence', type=float, default=0.99, metavar='C',
+                        help="Confidence for the sampled early exit (default: 0.99)")
+    parser.add_argument('--sample-stride', type=int, default=16, metavar='N',
+                        help="Stride of the first sampling round (default: 16)")
+    parser.add_argument('--verify-sampling', action='store_true',
+                        help="Check the sampled selection against full scoring")
+    parser.add_argument('--outputs', default=','.join(DEFAULT_OUTPUTS), metavar='LIST',
+                        help="Outputs to write, comma-separated, from " + ",".join(OUTPUT_WRITERS)
+                             + " (default: " + ",".join(DEFAULT_OUTPUTS) + ")")
+    parser.add_argument('--preview-style', choices=['fast', 'matplotlib'], default='fast',
+                        help="Preview renderer: built-in LUT/PNG (default) or matplotlib figure")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Ignore the manifest and convert from scratch")
+    parser.add_argument('--zarr-chunks', default='64,128,128', metavar='Z,Y,X',
+                        help="OME-Zarr chunk shape (default: 64,128,128)")
+    parser.add_argument('--writer-threads', type=int, default=None, metavar='N',
+                        help="Threads for the output writers (default: one per output)")
+    parser.add_argument('--tiff-format', choices=['imagej', 'bigtiff'], default='imagej',
+                        help="TIFF layout: ImageJ stack (default) or tiled, compressed BigTIFF")
+    parser.add_argument('--tiff-compression', choices=['zlib', 'lzw', 'zstd'], default='zlib',
+                        help="BigTIFF tile compression (default: zlib)")
+    parser.add_argument('--tiff-tile', type=int, default=256, metavar='N',
+                        help="BigTIFF tile size in pixels, a multiple of 16 (default: 256)")
+    parser.add_argument('--nifti-compression', choices=['gzip', 'parallel', 'none'], default='gzip',
+                        help="NIfTI compression: gzip (default), parallel block gzip, or none (.nii)")
+    parser.add_argument('--nifti-level', type=int, choices=range(1, 10), default=1, metavar='L',
+                        help="gzip level 1-9 for the NIfTI (default: 1)")
+    parser.add_argument('--nifti-benchmark', action='store_true',
+                        help="Benchmark NIfTI compression settings on the selected volume")
+    args = parser.parse_args(argv)
+    
+    if args.workers < 0:
+        parser.error("--workers must be >= 0")
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads must be >= 1")
+    if not 0 < args.sample_confidence < 1:
+        parser.error("--sample-confidence must be between 0 and 1")
+    if args.sample_stride < 1:
+        parser.error("--sample-stride must be >= 1")
+    if args.preview_decode and (args.sample or args.verify_sampling):
+        parser.error("--preview-decode cannot be combined with sampled scoring")
+    args.outputs = [name.strip() for name in args.outputs.split(',') if name.strip()]
+    unknown = [name for name in args.outputs if name not in OUTPUT_WRITERS]
+    if unknown or not args.outputs:
+        parser.error(f"--outputs: choose from {', '.join(OUTPUT_WRITERS)}")
+    args.outputs = list(dict.fromkeys(args.outputs))
+    try:
+        args.zarr_chunks = tuple(int(n) for n in args.zarr_chunks.split(','))
+    except ValueError:
+        args.zarr_chunks = ()
+    if len(args.zarr_chunks) != 3 or min(args.zarr_chunks) < 1:
+        parser.error("--zarr-chunks must be three positive integers Z,Y,X")
+    if args.tiff_tile < 16 or args.tiff_tile % 16:
+        parser.error("--tiff-tile must be a positive multiple of 16")
+    if args.writer_threads is not None and args.writer_threads < 1:
+        parser.error("--writer-threads must be >= 1")
+    try:
+        args.score_weights = parse_score_spec(args.score)
+    except ValueError as e:
+        parser.error(f"--score: {e}")
+    
+    return args
+
+def main():
+    if len(sys.argv) < 2:
+        print("\n" + "="*80)
+        print("Zeiss Cirrus OCTA DICOM to TIFF Converter")
+        print("="*80)
+        print("\nUsage: python Zeiss_OCTA_Converter.py <folder_name>")
+        print("\nExample: python Zeiss_OCTA_Converter.py HenkE433")
+        print("\nOptions:")
+        print("  --workers N   Decode DICOM files on N processes (0 = all cores)")
+        print("  --threads N   Frame-decoding threads per file")
+        print("  --no-prescan  Decompress every file (skip header pre-scan)")
+        print("  --no-dedupe   Do not skip duplicate volumes (identical PixelData)")
+        print("  --preview-decode N   Score from 1/N of the B-scans, decode only the winner")
+        print("  --preview-report     Compare preview and full-decode rankings")
+        print("  --no-cache    Do not use the decoded-volume cache")
+        print("  --clear-cache Delete all cached volumes")
+        print("  --repair-report      Report header repairs for the folder")
+        print("  --score SPEC  Selection metrics, e.g. contrast,vessels:0.01")
+        print("  --sample      Score from sampled B-scans, stop when the leader is clear")
+        print("  --verify-sampling    Check sampled selection against full scoring")
+        print("  --outputs LIST       Outputs to write, e.g. npy,json,tiff")
+        print("  --rebuild     Convert from scratch even if nothing changed")
+        print("  --tiff-format bigtiff  Tiled, compressed BigTIFF (--tiff-compression zlib|lzw|zstd)")
+        print("  --nifti-compression {gzip,parallel,none}, --nifti-level L")
+        print("  --nifti-benchmark    Compare NIfTI compression size and time")
+        print("  --preview-style matplotlib   Titled matplotlib preview (default: built-in PNG)")
+        print("\nThe script will:")
+        print("  1. Read all DICOM files in the folder")
+        print("  2. Fix corrupted metadata and decompress JPEG 2000")
         print("  3. Select the best volume")
         print("  4. Export to TIFF, NPY, and generate preview")
         print("="*80 + "\n")
         return False
     
-    folder_name = sys.argv[1]
+    args = parse_args(sys.argv[1:])
+    folder_name = args.folder_name
     
     print("\n" + "="*80)
     print("Zeiss Cirrus OCTA DICOM to TIFF Converter")
@@ -284,66 +3160,176 @@ def main():
             print(f"  - {loc}")
         return False
     
-    # Read DICOM files
-    dcm_files = sorted(data_folder.glob("*.DCM"))
-    dcm_files = [f for f in dcm_files if f.name != "DICOMDIR"]
+    # Decoded-volume cache
+    cache = VolumeCache(args.cache_dir, int(args.cache_size * 1024**3)) if args.cache else None
+    if args.clear_cache:
+        removed = VolumeCache(args.cache_dir, 0).clear()
+        print(f"Cleared {removed} cached volumes from {args.cache_dir}\n")
+    
+    if args.preview_report:
+        factor = args.preview_decode or 4
+        is_exam = lambda d: (d / "DICOMDIR").exists() or any(d.glob("*.DCM"))
+        exam_folders = [data_folder] if is_exam(data_folder) else \
+            sorted(d for d in data_folder.iterdir() if d.is_dir() and is_exam(d))
+        print(f"Preview ranking report (1/{factor} of B-scans, {len(exam_folders)} exams)\n")
+        preview_ranking_report(exam_folders, factor)
+        return True
+    
+    # Read DICOM files (from DICOMDIR when present)
+    dcm_files, dicomdir_index = enumerate_dicom_files(data_folder)
+    if dicomdir_index is not None:
+        print_dicomdir_index(dicomdir_index)
     print(f"Found {len(dcm_files)} DICOM files\n")
     
     if len(dcm_files) == 0:
         print("ERROR: No DICOM files found!")
         return False
     
-    # Read all files
-    print("Reading files...")
-    all_data = []
+    if args.repair_report:
+        print("Repairing headers...")
+        repair_folder_headers(dcm_files)
+        return True
     
-    for i, file_path in enumerate(dcm_files, 1):
-        print(f"\n[{i}/{len(dcm_files)}] {file_path.name}")
-        
-        image, dcm = read_dicom_robust(file_path)
-        
-        if image is None:
-            continue
-        
-        print(f"  ✓ Shape: {image.shape}, Dtype: {image.dtype}")
-        all_data.append((image, dcm, file_path.name))
+    # Frame-decoding threads per file: share the cores between the processes
+    # (only effective with imagecodecs, see _j2k_decoder)
+    cpu_count = os.cpu_count() or 1
+    threads = args.threads or max(1, cpu_count // (args.workers or cpu_count))
     
-    if len(all_data) == 0:
-        print("\nERROR: No valid volumes could be read!")
-        return False
+    # Output folder: Results/<folder_name>/
+    script_dir = Path(__file__).parent
+    output_folder = script_dir / "Results" / folder_name
+    base_name = f"OCTA_{folder_name}"
     
-    print(f"\n{'='*80}")
-    print(f"Successfully read {len(all_data)} volumes")
-    print('='*80)
+    writer_options = {
+        'tiff_format': args.tiff_format,
+        'tiff_compression': args.tiff_compression,
+        'tiff_tile': args.tiff_tile,
+        'zarr_chunks': args.zarr_chunks,
+        'nifti_compression': args.nifti_compression,
+        'nifti_level': args.nifti_level,
+        'preview_style': args.preview_style,
+        'threads': cpu_count,
+    }
+    
+    # Incremental rebuild: with unchanged inputs, converter and selection
+    # options, keep the previous selection and rebuild only stale outputs
+    manifest_path = output_folder / MANIFEST_NAME
+    selection_options = {key: getattr(args, key) for key in MANIFEST_SELECTION_OPTIONS}
+    # --rebuild ignores the previous manifest for reuse, but its input hashes
+    # still spare re-reading files whose size and mtime are unchanged
+    previous = None if args.nifti_benchmark else load_manifest(manifest_path)
+    inputs = {} if args.nifti_benchmark else input_fingerprints(dcm_files, data_folder, previous)
+    if args.rebuild:
+        previous = None
+    reuse = previous is not None and manifest_matches(previous, inputs, selection_options)
+    outputs = args.outputs
+    if reuse:
+        outputs = stale_outputs(previous, output_folder, args.outputs, writer_options)
+        if not outputs:
+            print(f"Up to date: inputs, converter and options unchanged "
+                  f"({manifest_path.relative_to(script_dir)})")
+            return True
+        print(f"Inputs unchanged since the last conversion; rebuilding: {', '.join(outputs)}")
     
-    # Select best volume
-    volume_3d, selected_dcm, selected_name = select_best_volume(all_data)
+    # The .npy is created up front and filled in place by decoding/conversion
+    # (see OCTAVolume.write_npy)
+    def npy_target():
+        if 'npy' not in outputs or args.nifti_benchmark:
+            return None
+        output_folder.mkdir(parents=True, exist_ok=True)
+        return output_folder / f"{base_name}.npy"
+    npy_path = npy_target()
     
-    if volume_3d is None:
+    volume = None
+    if reuse:
+        volume = load_previous_volume(previous, data_folder, output_folder / f"{base_name}.npy",
+                                      npy_path, cache, threads)
+        duplicates = previous.get('skipped_duplicates', [])
+        if volume is None:
+            print("  Warning: Could not reuse the previous selection, converting from scratch")
+            reuse = False
+            outputs = args.outputs
+            npy_path = npy_target()
+        print()
+    
+    if volume is None:
+        # Header pre-scan: only decompress files that can be selected
+        target_shape = None
+        if args.prescan:
+            print("Scanning headers...")
+            candidate_files, target_shape = prescan_headers(dcm_files, dicomdir_index)
+            if candidate_files:
+                print(f"  {len(candidate_files)} of {len(dcm_files)} files have the majority shape {target_shape}\n")
+                dcm_files = candidate_files
+            else:
+                print("  No 3D volumes found in headers, decompressing all files\n")
+        
+        # Skip exact duplicates (identical compressed PixelData) before decoding
+        duplicates = []
+        if args.dedupe:
+            print("Checking for duplicate volumes...")
+            dcm_files, duplicates = dedupe_volumes(dcm_files, data_folder, inputs)
+            for dup in duplicates:
+                print(f"  Skipping {dup['file']} (same pixel data as {dup['duplicate_of']})")
+            print(f"  {len(duplicates)} duplicates, {len(dcm_files)} files to decode\n")
+        
+        if args.preview_decode:
+            # Preview decode: score from a subset of B-scans, decode only the winner
+            volume = select_best_volume_preview(dcm_files, args.preview_decode, cache, threads, npy_path,
+                                                args.score_weights, target_shape)
+        elif args.sample or args.verify_sampling:
+            # Sampled scoring: B-scan subsets with confidence-based early exit
+            volume, _ = select_best_volume_sampled(dcm_files, args.score_weights, args.sample_confidence,
+                                                   args.sample_stride, cache, threads,
+                                                   None if args.verify_sampling else npy_path, target_shape)
+            if args.verify_sampling:
+                print("\nVerifying against full scoring...")
+                full_volume = select_best_volume(iter_volumes(dcm_files, args.workers, cache, threads),
+                                                 args.score_weights)
+                sampled_path = volume.path if volume is not None else None
+                full_path = full_volume.path if full_volume is not None else None
+                sampled_name = volume.name if volume is not None else None
+                full_name = full_volume.name if full_volume is not None else None
+                if sampled_path == full_path:
+                    print(f"\nSampling check: {sampled_name} selected by both sampled and full scoring")
+                else:
+                    print(f"\nSampling check: MISMATCH (sampled: {sampled_name}, full: {full_name})")
+                volume = full_volume
+        else:
+            # Read and score files one at a time (streaming selection)
+            if args.workers != 1:
+                print(f"Reading files ({args.workers or os.cpu_count()} processes)...")
+            else:
+                print("Reading files...")
+        
+            volumes = iter_volumes(dcm_files, args.workers, cache, threads)
+            volume = select_best_volume(volumes, args.score_weights)
+    
+    if volume is None:
         print("ERROR: Could not select a volume!")
         return False
+    selected_dcm, selected_path = volume.dcm, volume.path
+    selected_name = selected_path.relative_to(data_folder).as_posix()
     
     # Process volume
     print(f"\n{'='*80}")
     print("Processing Volume")
     print('='*80)
-    print(f"Shape: {volume_3d.shape} (Y, X, Z)")
-    print(f"Dtype: {volume_3d.dtype}")
-    print(f"Range: [{volume_3d.min()}, {volume_3d.max()}]")
-    
-    # Convert to uint8
-    if volume_3d.dtype == np.int8:
-        volume_uint8 = volume_3d.astype(np.int16) + 128
-        volume_uint8 = volume_uint8.astype(np.uint8)
+    print(f"Shape: {volume.shape} (Y, X, Z)")
+    print(f"Dtype: {volume.source_dtype}")
+    print(f"Range: [{volume.source_range[0]}, {volume.source_range[1]}]")
+    
+    # Convert to uint8 (shared with scoring, so usually already done),
+    # written into the .npy so every writer reads the mapped file
+    if npy_path is not None:
+        volume_uint8 = volume.write_npy(npy_path)
     else:
-        vol_normalized = volume_3d.astype(np.float32)
-        vol_normalized = (vol_normalized - vol_normalized.min()) / (vol_normalized.max() - vol_normalized.min())
-        volume_uint8 = (vol_normalized * 255).astype(np.uint8)
+        volume_uint8 = volume.uint8
     
     print(f"Converted to: uint8 [0, 255]")
     
     # Calculate voxel size
-    voxel_x, voxel_y, voxel_z, scan_width, scan_depth = calculate_voxel_size(volume_3d.shape)
+    voxel_x, voxel_y, voxel_z, scan_width, scan_depth = calculate_voxel_size(volume.shape)
     
     print(f"\nVoxel size (estimated):")
     print(f"  X: {voxel_x:.3f} µm")
@@ -351,176 +3337,94 @@ def main():
     print(f"  Z: {voxel_z:.3f} µm")
     print(f"Scan dimensions: {scan_width}x{scan_width}x{scan_depth} mm")
     
+    if args.nifti_benchmark:
+        print(f"\n{'='*80}")
+        benchmark_nifti(volume_uint8, (voxel_x, voxel_y, voxel_z), cpu_count)
+        return True
+    
     # Save files
     print(f"\n{'='*80}")
     print("Saving Files")
     print('='*80 + "\n")
     
     # Create output folder structure: Results/<folder_name>/
-    script_dir = Path(__file__).parent
-    results_base = script_dir / "Results"
-    output_folder = results_base / folder_name
     output_folder.mkdir(parents=True, exist_ok=True)
     
-    base_name = f"OCTA_{folder_name}"
-    
     print(f"Output folder: {output_folder.relative_to(script_dir)}\n")
     
-    # 1. NumPy
-    npy_path = output_folder / f"{base_name}.npy"
-    np.save(npy_path, volume_uint8)
-    print(f"[1] NumPy: {npy_path.name} ({npy_path.stat().st_size / 1024 / 1024:.2f} MB)")
-    
-    # 2. Metadata
     meta_data = {
         'source_folder': folder_name,
         'source_file': selected_name,
-        'shape': list(volume_3d.shape),
+        'shape': list(volume.shape),
         'shape_description': 'Y (B-scans), X (width), Z (depth)',
         'dtype': 'uint8',
         'voxel_size_um': {'X': float(voxel_x), 'Y': float(voxel_y), 'Z': float(voxel_z)},
         'scan_dimensions_mm': {'width': scan_width, 'depth': scan_depth},
         'patient_id': str(getattr(selected_dcm, 'PatientID', 'Unknown')),
         'study_date': str(getattr(selected_dcm, 'StudyDate', 'Unknown')),
-        'device': 'Zeiss Cirrus HD-OCT'
+        'device': 'Zeiss Cirrus HD-OCT',
+        'skipped_duplicates': duplicates
     }
     
-    json_path = output_folder / f"{base_name}_metadata.json"
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(meta_data, f, indent=2)
-    print(f"[2] Metadata: {json_path.name}")
+    # Projections shared by the preview and the metadata statistics: cached
+    # from scoring, otherwise computed here in one pass before the writers start
+    projections = volume.projections() if {'json', 'preview'} & set(outputs) else {}
+    if 'histogram' in projections:
+        meta_data['intensity_statistics'] = histogram_statistics(projections['histogram'])
+        meta_data['intensity_statistics']['en_face_mip_contrast'] = float(projections['max_z'].std())
     
-    # 3. TIFF for Imaris
-    try:
-        import tifffile
-        
-        tiff_path = output_folder / f"{base_name}.tif"
-        
-        # Transpose to (Z, Y, X) for ImageJ/Imaris
-        volume_zyx = np.transpose(volume_uint8, (2, 0, 1))
-        
-        print(f"[3] TIFF: Transposed to {volume_zyx.shape} (Z, Y, X)")
-        
-        # Resolution in pixels per mm
-        resolution_x = 1000.0 / voxel_x  # pixels per mm
-        resolution_y = 1000.0 / voxel_y
-        spacing_z = voxel_z / 1000  # mm
-        
-        tifffile.imwrite(
-            tiff_path,
-            volume_zyx,
-            imagej=True,
-            resolution=(resolution_y, resolution_x),
-            metadata={'spacing': spacing_z, 'unit': 'um', 'axes': 'ZYX'}
-        )
-        
-        file_size = tiff_path.stat().st_size / 1024 / 1024
-        print(f"    Saved: {tiff_path.name} ({file_size:.2f} MB)")
-        print(f"    ✓ Ready for Imaris!")
-        
-    except Exception as e:
-        print(f"[3] TIFF: ERROR - {e}")
+    # Writers run concurrently and share the uint8 volume
+    job = ExportJob(volume_uint8, output_folder, base_name, folder_name,
+                    (voxel_x, voxel_y, voxel_z), meta_data, writer_options)
+    job.projections = projections
+    status = write_outputs(job, outputs, args.writer_threads)
+    written = [name for name in outputs if status[name] == 'ok']
+    failed = [name for name in outputs if status[name] == 'failed']
     
-    # 4. NIfTI for medical imaging software
-    try:
-        import nibabel as nib
-        
-        nifti_path = output_folder / f"{base_name}.nii.gz"
-        
-        # NIfTI uses RAS+ coordinate system, we use (X, Y, Z) orientation
-        # Volume is already in (Y, X, Z), transpose to (X, Y, Z) for standard neuroimaging
-        volume_xyz = np.transpose(volume_uint8, (1, 0, 2))
-        
-        # Create affine matrix with voxel sizes (in mm)
-        # NIfTI expects voxel sizes in mm
-        affine = np.array([
-            [voxel_x / 1000, 0, 0, 0],
-            [0, voxel_y / 1000, 0, 0],
-            [0, 0, voxel_z / 1000, 0],
-            [0, 0, 0, 1]
-        ])
-        
-        # Create NIfTI image
-        nifti_img = nib.Nifti1Image(volume_xyz, affine)
-        
-        # Add metadata to header
-        nifti_img.header['descrip'] = f'Zeiss OCTA {folder_name}'.encode('utf-8')
-        nifti_img.header['xyzt_units'] = 2  # mm for spatial units
-        
-        # Save compressed NIfTI
-        nib.save(nifti_img, str(nifti_path))
-        
-        file_size = nifti_path.stat().st_size / 1024 / 1024
-        print(f"[4] NIfTI: {nifti_path.name} ({file_size:.2f} MB)")
-        print(f"    Shape: {volume_xyz.shape} (X, Y, Z)")
-        print(f"    Voxel size: {voxel_x/1000:.4f} x {voxel_y/1000:.4f} x {voxel_z/1000:.4f} mm")
-        print(f"    ✓ Ready for medical imaging software!")
-        
-    except ImportError:
-        print(f"[4] NIfTI: Skipped (nibabel not installed)")
-        print(f"    Install with: pip install nibabel")
-    except Exception as e:
-        print(f"[4] NIfTI: ERROR - {e}")
-    
-    # 5. Preview
-    try:
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot as plt
-        
-        print(f"\n[5] Generating preview...")
-        
-        # Maximum intensity projections
-        mip_z = np.max(volume_uint8, axis=2)
-        mip_y = np.max(volume_uint8, axis=0)
-        mip_x = np.max(volume_uint8, axis=1)
-        
-        fig, axes = plt.subplots(2, 2, figsize=(12, 12))
-        
-        axes[0, 0].imshow(mip_z, cmap='hot')
-        axes[0, 0].set_title(f'En Face (MIP Z)\n{folder_name}', fontsize=12, weight='bold')
-        axes[0, 0].axis('off')
-        
-        axes[0, 1].imshow(mip_y, cmap='hot', aspect='auto')
-        axes[0, 1].set_title('Side view (MIP Y)', fontsize=10)
-        axes[0, 1].axis('off')
-        
-        axes[1, 0].imshow(mip_x, cmap='hot', aspect='auto')
-        axes[1, 0].set_title('Side view (MIP X)', fontsize=10)
-        axes[1, 0].axis('off')
-        
-        # Central depth slice
-        central_z = volume_uint8.shape[2] // 2
-        axes[1, 1].imshow(volume_uint8[:, :, central_z], cmap='gray')
-        axes[1, 1].set_title(f'Central depth slice (Z={central_z})', fontsize=10)
-        axes[1, 1].axis('off')
-        
-        plt.tight_layout()
-        preview_path = output_folder / f"{base_name}_Preview.png"
-        plt.savefig(preview_path, dpi=150, bbox_inches='tight')
-        plt.close()
-        print(f"    Preview: {preview_path.name}")
-        
-    except Exception as e:
-        print(f"[5] Preview: ERROR - {e}")
+    # Record inputs and outputs for incremental re-runs
+    recorded = {name: entry for name, entry in previous['outputs'].items()
+                if name not in outputs} if reuse else {}
+    for name in written:
+        entry = output_fingerprint(job.paths[name])
+        entry['options'] = output_options(name, writer_options)
+        recorded[name] = entry
+    write_manifest(manifest_path, {
+        'manifest_version': MANIFEST_VERSION,
+        'converter': converter_fingerprint(),
+        'inputs': inputs,
+        'selection_options': _as_json(selection_options),
+        'selected_file': selected_name,
+        'source_dtype': str(volume.source_dtype),
+        'source_range': [np.asarray(v).item() for v in volume.source_range],
+        'skipped_duplicates': duplicates,
+        'outputs': recorded,
+    })
     
     # Summary
     print(f"\n{'='*80}")
-    print("SUCCESS!")
+    print("SUCCESS!" if not failed else f"DONE ({len(failed)} outputs failed: {', '.join(failed)})")
     print('='*80)
     print(f"\nOutput files:")
-    print(f"  - {base_name}.tif (for Imaris)")
-    print(f"  - {base_name}.nii.gz (for medical imaging software: ITK-SNAP, 3D Slicer, etc.)")
-    print(f"  - {base_name}.npy (NumPy array for Python)")
-    print(f"  - {base_name}_metadata.json (scan parameters)")
-    print(f"  - {base_name}_Preview.png (visualization)")
-    print(f"\nFor Imaris:")
-    print(f"  1. Open {base_name}.tif")
-    print(f"  2. Voxel size is embedded: X={voxel_x:.3f}, Y={voxel_y:.3f}, Z={voxel_z:.3f} µm")
-    print(f"  3. Adjust contrast/brightness if needed")
-    print(f"\nFor other software (ITK-SNAP, 3D Slicer, etc.):")
-    print(f"  1. Open {base_name}.nii.gz")
-    print(f"  2. Voxel size is embedded in NIfTI header")
+    descriptions = {
+        'tiff': "(for Imaris)",
+        'nifti': "(for medical imaging software: ITK-SNAP, 3D Slicer, etc.)",
+        'ims': "(native Imaris, no conversion on open)",
+        'zarr': "(OME-Zarr, chunked for lazy reading)",
+        'npy': "(NumPy array for Python)",
+        'json': "(scan parameters)",
+        'preview': "(visualization)",
+    }
+    for name in written:
+        print(f"  - {job.paths[name].name} {descriptions.get(name, '')}".rstrip())
+    if 'tiff' in written or 'ims' in written:
+        print(f"\nFor Imaris:")
+        print(f"  1. Open {job.paths['ims' if 'ims' in written else 'tiff'].name}")
+        print(f"  2. Voxel size is embedded: X={voxel_x:.3f}, Y={voxel_y:.3f}, Z={voxel_z:.3f} µm")
+        print(f"  3. Adjust contrast/brightness if needed")
+    if 'nifti' in written:
+        print(f"\nFor other software (ITK-SNAP, 3D Slicer, etc.):")
+        print(f"  1. Open {job.paths['nifti'].name}")
+        print(f"  2. Voxel size is embedded in NIfTI header")
     print('='*80 + "\n")
     
     return True